@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+#
+#   Copyright (c) 2022    MultisampledNight, TornaxO7, UltimateNyn
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline benchmarks for Archer. They need the same dependencies as the bot
+itself, but neither a token nor network access.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import shlex
+import tempfile
+import time
+import types
+
+import main
+
+# the real client, before the benchmarks replace it with a FakeClient
+ARCHER = main.client
+
+PREFIX = "archer "
+CHAT = [
+    "hat jemand eine Idee, warum mein WLAN nach dem Update weg ist?",
+    "ich würde mal `journalctl -b -u NetworkManager` anschauen",
+    "lol",
+    "Welchen Kernel benutzt du denn?\nlinux-lts oder den normalen?",
+    "Arch ist halt einfach das beste, da gibt es nichts zu diskutieren",
+    "guten morgen zusammen :)",
+    "```\nerror: failed to commit transaction (conflicting files)\n```",
+    "hast du pacman -Syu schon probiert?",
+]
+COMMANDS = [
+    "archer help",
+    "archer lookup linux",
+    "archer leetify \"hallo welt\"",
+]
+# commands for the event replay, which can't go to the network
+REPLAY_COMMANDS = [
+    "archer lookup linux",
+    "archer lookup linux glibc pacman",
+    "archer search pac",
+    "archer whoami",
+    "archer leetify \"hallo welt\"",
+    "archer whoami\narcher lookup bash\narcher borkify hallo",
+]
+PACKAGES = ["linux", "linux-lts", "linux-zen", "glibc", "pacman", "pacman-contrib", "bash", "zsh", "vim"]
+
+
+def old_dispatch(content: str, prefix: str):
+    """ How on_message looked at every message before the fast path. """
+    is_command = False
+    for line in content.splitlines():
+        if line.startswith(prefix):
+            is_command = True
+            shlex.split(line[len(prefix):])
+    return "arch" in content.lower() and not is_command
+
+
+def new_dispatch(content: str, prefix: str):
+    lines = main.command_lines(content, prefix)
+    for line in lines:
+        main.tokenize(line)
+    return not lines and "arch" in content.lower()
+
+
+def bench_dispatch(dispatch, messages: list, rounds: int = 20) -> float:
+    """ Returns how many messages per second the given dispatcher handles. """
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for content in messages:
+            dispatch(content, PREFIX)
+    return rounds * len(messages) / (time.perf_counter() - started)
+
+
+class FakeRest:
+    """
+    Stands in for discord's REST API: every request just takes a while,
+    latency seconds give or take jitter, and is counted by its route.
+    """
+
+    def __init__(self, latency: float, jitter: float = 0.5):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = collections.Counter()  # key is the route
+        self.inflight = 0
+
+    async def request(self, route: str):
+        self.calls[route] += 1
+        self.inflight += 1
+        try:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        finally:
+            self.inflight -= 1
+
+
+class FakeRole:
+    def __init__(self, guild, role_id: int, name: str):
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+
+    def is_default(self) -> bool:
+        return self.id == self.guild.id
+
+
+class FakeMember:
+    def __init__(self, guild, member_id: int):
+        self.guild = guild
+        self.id = member_id
+        self.name = f"member{member_id}"
+        self.discriminator = "0001"
+        self.roles = [guild.default_role]
+
+    async def edit(self, roles: list, reason: str = None):
+        await self.guild.rest.request("PATCH /guilds/{guild_id}/members/{user_id}")
+        self.roles = [self.guild.default_role] + roles
+
+
+class FakeChannel:
+    def __init__(self, guild, channel_id: int):
+        self.guild = guild
+        self.id = channel_id
+
+    async def send(self, content: str):
+        await self.guild.rest.request("POST /channels/{channel_id}/messages")
+
+    def get_partial_message(self, message_id: int):
+        return types.SimpleNamespace(id=message_id, channel=self)
+
+
+class FakeGuild:
+    def __init__(self, rest: FakeRest, guild_id: int, member_count: int, role_count: int):
+        self.rest = rest
+        self.id = guild_id
+        self.default_role = FakeRole(self, guild_id, "@everyone")
+        self.roles = [self.default_role] + [
+            FakeRole(self, guild_id + 1 + i, f"role{i}") for i in range(role_count)]
+        self.channel = FakeChannel(self, guild_id + 100)
+        self.members = {member_id: FakeMember(self, member_id)
+                        for member_id in range(guild_id + 1000, guild_id + 1000 + member_count)}
+
+    def get_role(self, role_id: int):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+    async def fetch_member(self, member_id: int):
+        await self.rest.request("GET /guilds/{guild_id}/members/{user_id}")
+        return self.members[member_id]
+
+    def __str__(self):
+        return f"guild{self.id}"
+
+
+class FakeClient:
+    """ Just enough of discord.Client for the event handlers in main. """
+
+    def __init__(self, guild: FakeGuild):
+        self.user = types.SimpleNamespace(id=1, name="archer", discriminator="0000")
+        self.guilds = [guild]
+        self.latency = 0.0
+
+    def get_guild(self, guild_id: int):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def get_channel(self, channel_id: int):
+        return next((guild.channel for guild in self.guilds if guild.channel.id == channel_id), None)
+
+    def get_emoji(self, emoji_id: int):
+        return None
+
+
+MENU_MESSAGE = 500
+OTHER_MESSAGE = 501
+
+
+def synthetic_events(guild: FakeGuild, count: int, emojis: list) -> list:
+    """
+    Events as in a busy help guild: mostly chat, some commands, and people
+    picking and dropping roles on the role menu (besides reacting elsewhere).
+    """
+    member_ids = list(guild.members)
+    events = []
+    for _ in range(count):
+        author = random.choice(member_ids)
+        draw = random.random()
+        if draw < 0.6:
+            events.append({"type": "message", "author": author, "content": random.choice(CHAT)})
+        elif draw < 0.65:
+            events.append({"type": "message", "author": author, "content": random.choice(REPLAY_COMMANDS)})
+        else:
+            kind = "reaction_add" if draw < 0.85 else "reaction_remove"
+            message = MENU_MESSAGE if random.random() < 0.7 else OTHER_MESSAGE
+            events.append({"type": kind, "user": author, "message": message, "emoji": random.choice(emojis)})
+    return events
+
+
+def to_handler_call(guild: FakeGuild, event: dict):
+    """ Returns the handler for the given event and its argument, like discord.py would call it. """
+    if event["type"] == "message":
+        message = types.SimpleNamespace(
+            id=random.getrandbits(48), author=guild.members[event["author"]], guild=guild,
+            channel=guild.channel, content=event["content"], mentions=[])
+        return main.on_message, message
+    payload = types.SimpleNamespace(
+        guild_id=guild.id, channel_id=guild.channel.id, message_id=event["message"],
+        user_id=event["user"], emoji=types.SimpleNamespace(id=event["emoji"]),
+        member=guild.members[event["user"]] if event["type"] == "reaction_add" else None)
+    if event["type"] == "reaction_add":
+        return main.on_raw_reaction_add, payload
+    return main.on_raw_reaction_remove, payload
+
+
+def percentile(values: list, fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def fake_bot(args) -> tuple:
+    """ Points main at a fake guild with a role menu. Returns (rest, guild, emojis). """
+    rest = FakeRest(args.latency / 1000)
+    guild = FakeGuild(rest, 10 ** 6, args.members, 8)
+    emojis = [900 + i for i in range(len(guild.roles) - 1)]
+
+    main.client = FakeClient(guild)
+    main.admin_id = None
+    main.scheduler = main.RestScheduler()
+    main.role_updates = main.RoleUpdateQueue(args.window)
+    main.sync_index.packages = {name: ("1.0-1", 2 ** 20, 1650000000) for name in PACKAGES}
+    for name in PACKAGES:
+        main.name_index.add(name)
+
+    # another benchmark might have left settings for the same guild id behind
+    main.forget_settings(guild.id)
+    settings = main.guild_settings(guild)
+    settings.mod_role = guild.roles[1]
+    settings.menus = {guild.channel.id: main.RoleMenu(
+        guild.channel.id, MENU_MESSAGE,
+        {str(emoji): role for emoji, role in zip(emojis, guild.roles[1:])})}
+    settings.save()
+    return rest, guild, emojis
+
+
+async def replay(args) -> dict:
+    """
+    Replays events against a fake guild through the real handlers of main,
+    with everything sent to discord going to a FakeRest instead.
+    """
+    rest, guild, emojis = fake_bot(args)
+    if args.events:
+        with open(args.events) as fh:
+            events = [json.loads(line) for line in fh if line.strip()]
+    else:
+        events = synthetic_events(guild, args.count, emojis)
+    if args.record:
+        with open(args.record, "w") as fh:
+            fh.writelines(json.dumps(event) + "\n" for event in events)
+
+    latencies = collections.defaultdict(list)  # key is the event type
+
+    async def handle(event):
+        handler, arg = to_handler_call(guild, event)
+        started = time.perf_counter()
+        await handler(arg)
+        latencies[event["type"]].append(time.perf_counter() - started)
+
+    # like the gateway: every event gets its own task and nobody waits for them
+    started = time.perf_counter()
+    tasks = []
+    for event in events:
+        tasks.append(asyncio.ensure_future(handle(event)))
+        await asyncio.sleep(1 / args.rate if args.rate else 0)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    # role updates are applied after the window, wait for them as well
+    await asyncio.sleep(args.window)
+    while len(main.role_updates) or len(main.scheduler) or rest.inflight:
+        await asyncio.sleep(0.01)
+    await main.scheduler.close()
+    await main.settings_store.close()
+    return {"events": len(events), "elapsed": elapsed, "latencies": latencies, "calls": rest.calls}
+
+
+async def run_events(args) -> dict:
+    """
+    Ordinary chat messages per second, handled through Archer._run_event
+    like the gateway does: directly, then with profiler in different modes.
+    """
+    rest, guild, _ = fake_bot(args)
+    messages = [to_handler_call(guild, {"type": "message", "author": author, "content": random.choice(CHAT)})[1]
+                for author in random.choices(list(guild.members), k=20000)]
+    modes = {
+        "direct": None,
+        "_run_event": main.Profiler(slow_threshold=0),
+        "slow handlers": main.Profiler(slow_threshold=0.1),
+        "profiling": main.Profiler(slow_threshold=0),
+    }
+    modes["profiling"].start()
+
+    results = {}
+    for mode, profiler in modes.items():
+        main.profiler = profiler
+        started = time.perf_counter()
+        for message in messages:
+            if profiler is None:
+                await main.on_message(message)
+            else:
+                await ARCHER._run_event(main.on_message, "on_message", message)
+        results[mode] = len(messages) / (time.perf_counter() - started)
+    await main.scheduler.close()
+    await main.settings_store.close()
+    return results
+
+
+def bench_run_events(args):
+    profiler = main.profiler
+    with tempfile.TemporaryDirectory() as directory:
+        main.settings_store = main.SettingsStore(os.path.join(directory, "archer.sqlite"))
+        results = asyncio.run(run_events(args))
+    main.profiler = profiler
+
+    print("event dispatch, ordinary chat")
+    for mode, rate in results.items():
+        print(f"  {mode:>15}: {rate:12.0f} messages/s")
+
+
+def bench_replay(args):
+    with tempfile.TemporaryDirectory() as directory:
+        main.settings_store = main.SettingsStore(os.path.join(directory, "archer.sqlite"))
+        result = asyncio.run(replay(args))
+
+    events = result["events"]
+    print(f"event replay, {events} events, {args.latency:g} ms REST latency")
+    print(f"  {events / result['elapsed']:12.0f} events/s")
+    for kind, latencies in sorted(result["latencies"].items()):
+        latencies.sort()
+        print(f"  {kind:>15}: {len(latencies):6} events, "
+              f"p50 {percentile(latencies, 0.5) * 1000:8.3f} ms, p99 {percentile(latencies, 0.99) * 1000:8.3f} ms")
+    total = sum(result["calls"].values())
+    print(f"  {total / events:12.3f} REST calls per event")
+    for route, calls in result["calls"].most_common():
+        print(f"  {calls:12} {route}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=5000, help="how many synthetic events to replay")
+    parser.add_argument("--events", help="replay the events in this file (JSON lines) instead")
+    parser.add_argument("--record", help="write the replayed events to this file")
+    parser.add_argument("--latency", type=float, default=50, help="latency of a REST request in ms")
+    parser.add_argument("--rate", type=float, default=0, help="events per second, 0 for as fast as possible")
+    parser.add_argument("--members", type=int, default=1000, help="members of the fake guild")
+    parser.add_argument("--window", type=float, default=main.ROLE_UPDATE_WINDOW,
+                        help="seconds role changes are collected, see RoleUpdateQueue")
+    args = parser.parse_args()
+
+    random.seed(0)
+    # like in the help channel: almost everything is ordinary chat
+    messages = [random.choice(COMMANDS) if random.random() < 0.01 else random.choice(CHAT)
+                for _ in range(10000)]
+
+    print("message dispatch, 99 % ordinary chat")
+    for name, dispatch in (("before", old_dispatch), ("after", new_dispatch)):
+        print(f"  {name:>6}: {bench_dispatch(dispatch, messages):12.0f} messages/s")
+
+    random.seed(0)
+    bench_run_events(args)
+
+    random.seed(0)
+    bench_replay(args)
@@ -15,17 +15,38 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import bisect
+import collections
+import contextvars
+import cProfile
 import datetime
+import heapq
+import itertools
+import io
 import json
 import logging
+import logging.handlers
 import os
+import pstats
+import queue
 import random
 import re
+import resource
 import shlex
-
+import signal
+import sqlite3
+import sys
+import tarfile
+import time
+import types
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import aiohttp
+import aiohttp.web
 import discord
-import lxml.html
-import requests
 from discord.utils import get
 
 
@@ -64,9 +85,15 @@ HELP_MSG = ["""\
         Macht die gegebenen Argumente kaputt, indem Anfangs- und Endbuchstaben
         vertauscht werden.
 
-    lookup <package>
-        Sucht nach dem angegebenen Paket auf https://archlinux.org/packages/ und
-        gibt die Version, die Größe und das Erstellungsdatum zurück.
+    lookup <package>...
+        Sucht nach den angegebenen Paketen auf https://archlinux.org/packages/
+        und gibt die Version, die Größe und das Erstellungsdatum zurück. Pakete,
+        die es dort nicht gibt, werden im AUR gesucht. Mit `aur/<package>` wird
+        nur im AUR gesucht.
+
+    search <term>
+        Sucht nach allen bekannten Paketen, die mit dem Begriff anfangen oder
+        ihn enthalten.
 
     set-mod-role <role-name>
         Setzt die Moderationsrolle, welche für das Verändern von Einstellungen
@@ -74,18 +101,24 @@ HELP_MSG = ["""\
 
     send-role-message <channel-id>
         Sendet die Nachricht mit der Rollenauswahl in den angegebenen Channel.
+        Jeder Channel kann ein eigenes Rollenmenü haben.
 
-    add-role <emoji> <role-name>
+    add-role <emoji> <role-name> [channel-id]
         Fügt eine Verlinkung zu der gegebenen Rolle hinzu, welche mithilfe des
         Emojis bei der Nachricht von send-role-message hinzugefügt werden kann.
+        Gibt es mehrere Rollenmenüs, muss der Channel angegeben werden.
 
-    remove-role <emoji>
+    remove-role <emoji> [channel-id]
         Entfernt die Verlinkung der Rolle mit dem Emoji.
 
     distraction-probability <probability>
         Setzt eine neue Ablenkungswahrscheinlichkeit. Die Wahrscheinlichkeit
         sollte zum Beispiel für 50 % als 50 angegeben werden, also ohne das
         Prozentzeichen.
+
+    profile start|stop|dump
+        Startet oder stoppt das Profiling der Befehle und Events, oder
+        speichert das bisherige Profil in persistent/.
 ```""",
 """\
 ```md
@@ -105,10 +138,83 @@ April 2021
 ```"""]
 
 VERSION = "0.2.3"
+STARTED = time.monotonic()  # to report how long starting up took
+MESSAGE_LIMIT = 2000  # maximum length of a single message, enforced by discord
 PERSISTENT_PATH= os.path.join(os.path.dirname(os.path.realpath(__file__)), "persistent")
-SAVEFILE = os.path.join(PERSISTENT_PATH, "settings")
-LOGFORMAT = "[%(asctime)s] <%(levelname)s> %(message)s"
+SAVEFILE = os.path.join(PERSISTENT_PATH, "settings")  # only read to import it into the database
+DATABASE = os.path.join(PERSISTENT_PATH, "archer.sqlite")
+SAVE_DELAY = 2  # seconds to wait for further changes before writing settings to disk
+ROLE_UPDATE_WINDOW = 1.5  # seconds to collect reaction role changes of a member for
+ROLE_UPDATE_RETRIES = 5  # how often a rate limited role update is tried at most
+ROLE_UPDATE_CONCURRENCY = 4  # how many role updates may be sent to discord at once
+# seconds the role changes Archer made count over the cached roles, which discord only updates a bit later
+ROLE_UPDATE_MEMORY = 10
+MENU_EDIT_DELAY = 1  # seconds to wait for further changes before editing a role menu
+MENU_HEADER = "Benutze die Reaktionen unter dieser Nachricht, um dir selber Rollen zu geben."
+REACTION_SEED_CONCURRENCY = 4  # how many reactions are added to a new role menu at once
+# keep only members who recently interacted with Archer in memory, see MemberCache
+LEAN_MEMBER_CACHE = os.getenv("LEAN_MEMBER_CACHE", "") not in ("", "0")
+MEMBER_CACHE_SIZE = 1024  # members kept in lean mode
+MEMBER_CACHE_TTL = 5 * 60  # seconds until a member is fetched again in lean mode
+RECONCILE_BATCH_SIZE = 100  # members whose roles are reconciled before logging progress
+# sharding, see launch: SHARD_COUNT 0 doesn't shard at all, SHARD_IDS empty handles all shards
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0))
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id]
+WORKERS = int(os.getenv("WORKERS", 1))  # processes the shards are spread over
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", -1))  # set by launch for the processes it starts
+NOTIFY_PORT = int(os.getenv("NOTIFY_PORT", 9140))  # worker i listens on NOTIFY_PORT + i, see PeerNotifier
+WORKER_RESTART_DELAY = 1  # seconds to wait before restarting a crashed worker, doubled on every crash
+WORKER_RESTART_DELAY_MAX = 60
+WORKER_STABLE_TIME = 60  # seconds a worker has to run to reset its restart delay
+# priorities of requests to discord, lower goes first
+PRIORITY_ROLES = 0
+PRIORITY_REPLIES = 1
+PRIORITY_DISTRACTIONS = 2
+PRIORITY_NAMES = {PRIORITY_ROLES: "Rollen", PRIORITY_REPLIES: "Antworten", PRIORITY_DISTRACTIONS: "Ablenkungen"}
+REST_SATURATION = 25  # from how many queued requests on distractions are dropped
+# requests per second discord allows a bot over all routes, shared by all worker processes
+REST_GLOBAL_RATE = 50 / WORKERS
+DISTRACTION_RATE = 1 / 60  # distractions per second a channel earns
+DISTRACTION_BURST = 3  # distractions a channel can save up
+LOGFORMAT = "[%(asctime)s] <%(levelname)s> %(message)s"  # with LOG_FORMAT=text, otherwise JSON, see JsonFormatter
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = 10000  # log records waiting to be written before further ones are dropped
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))  # fraction of frequent records logged, see log_sampled
+# where the metrics are served in the Prometheus text format, port 0 to not serve them
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9120))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # in seconds
+LOOP_LAG_INTERVAL = 0.5  # seconds between measuring how late the event loop is
+PROFILE_AT_BOOT = os.getenv("PROFILE", "") not in ("", "0")  # start profiling right away, see Profiler
+PROFILE_TOP = 50  # how many functions a profile dump lists
+# seconds a handler may hold the event loop at once before it is logged, 0 to not check at all
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("SLOW_CALLBACK_THRESHOLD", 0))
+PROFILED_EVENTS = ("on_message", "on_raw_reaction_add", "on_raw_reaction_remove")
+# events which need the settings, held back until they're loaded, see warm_up
+HELD_EVENTS = ("message", "raw_reaction_add", "raw_reaction_remove",
+               "raw_message_edit", "raw_message_delete", "raw_bulk_message_delete")
 EMOJI_REGEX = re.compile("<:.+:([0-9]+)>")
+QUOTING_REGEX = re.compile(r"[\"'\\]")  # anything shlex would treat specially
+TOKEN_REGEX = re.compile(r"[^ \t\r\n]+")  # what shlex splits into if there's no quoting
+PACKAGES_URL = os.getenv("PACKAGES_URL", "https://archlinux.org")
+AUR_URL = os.getenv("AUR_URL", "https://aur.archlinux.org")
+AUR_BATCH_SIZE = 100  # names per AUR RPC request, keeps the URL reasonably short
+AUR_BATCH_DELAY = 0.05  # seconds to wait for more names before asking the AUR
+LOOKUP_TIMEOUT = 10  # seconds a single request to archlinux.org may take at most
+LOOKUP_CONCURRENCY = 8  # how many requests to archlinux.org may run at once
+# all in seconds, except for the size
+LOOKUP_CACHE_TTL = int(os.getenv("LOOKUP_CACHE_TTL", 15 * 60))
+LOOKUP_CACHE_NEGATIVE_TTL = int(os.getenv("LOOKUP_CACHE_NEGATIVE_TTL", 5 * 60))
+LOOKUP_CACHE_STALE = int(os.getenv("LOOKUP_CACHE_STALE", 60 * 60))
+LOOKUP_CACHE_SIZE = int(os.getenv("LOOKUP_CACHE_SIZE", 2048))
+# directory with pacman sync databases, e.g. a mirror or /var/lib/pacman/sync
+SYNC_DB_PATH = os.getenv("SYNC_DB_PATH", os.path.join(PERSISTENT_PATH, "sync"))
+SYNC_DB_REPOS = ("core", "extra", "multilib")
+SYNC_DB_CHECK_INTERVAL = 60  # seconds between checking the databases for changes
+LOOKUP_BATCH_SIZE = 25  # how many packages a single lookup may ask for
+LOOKUP_BATCH_CONCURRENCY = int(os.getenv("LOOKUP_BATCH_CONCURRENCY", 4))
+SEARCH_RESULTS = 25  # how many package names search replies with at most
+SUGGESTIONS = 3  # how many names are suggested if lookup doesn't find a package
 ARCH_RESPONSES = [
     "ARCH IS THE BEST!",
     "Arch ist toll.",
@@ -137,45 +243,57 @@ class Package:
             version: str,
             size: int,
             creation_date: datetime.date,
-            publish_date: datetime.date):
+            publish_date: datetime.date,
+            aur: bool = False):
         self.name = name
         self.version = version
-        self.size = size
+        self.size = size  # None for AUR packages, they aren't built yet
         self.creation_date = creation_date
         self.publish_date = publish_date
+        self.aur = aur
 
-    def by_name(name: str):
+    @staticmethod
+    async def by_name(name: str):
         """
         Returns a new Arch-Package for the given package name. Note that this
         only searchs in the standard repositories, not in the AUR.
+
+        If sync databases are available, the package is looked up in them
+        instead, see SyncIndex. Otherwise results are cached, see LookupCache.
         """
+        if sync_index:
+            return sync_index.get(name.lower())
+        package = await lookup_cache.get(name.lower(), Package.fetch)
+        if package is not None:
+            name_index.add(package.name)
+        return package
+
+    @staticmethod
+    async def fetch(name: str):
+        """ Like by_name, but always asks archlinux.org. """
         # first search for the package using the "search packages" site
-        response = requests.get(f"https://archlinux.org/packages/?q={name}", stream=True)
-        if response.status_code != 200:
+        body = await lookup_client.get(f"{PACKAGES_URL}/packages/", params={"q": name})
+        if body is None:
             return None
-        response.raw.decode_content = True
-
-        tree = lxml.html.parse(response.raw)
-        element = tree.xpath("/html/body/div[2]/div[3]/table/tbody/tr/td[3]/a")
-        if not element:
+        href = await lookup_client.parse(_parse_search_page, body)
+        if href is None:
             return None
-        
+
         # then actually get the package contents
-        package_url = f"https://archlinux.org{element[0].get('href')}"
-        response = requests.get(package_url, stream=True)
-        if response.status_code != 200:
+        body = await lookup_client.get(f"{PACKAGES_URL}{href}")
+        if body is None:
             return None
-        response.raw.decode_content = True
-
-        tree = lxml.html.parse(response.raw)
-        name = tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[1]")[0].get("content")
-        version = tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[2]")[0].get("content")
-        size = int(tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[4]")[0].get("content"))
-        creation_date = datetime.date.fromisoformat(tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[5]")[0].get("content"))
-        publish_date = datetime.date.fromisoformat(tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[6]")[0].get("content"))
-        return Package(name, version, size, creation_date, publish_date)
-    
+        return await lookup_client.parse(_parse_package_page, body)
+
     def __repr__(self):
+        if self.aur:
+            return f"""\
+Name: `{self.name}`
+Version: `{self.version}`
+Zuletzt geändert: `{self.creation_date.strftime("%d.%m.%Y, %B")}`
+AUR: <{AUR_URL}/packages/{self.name}>
+"""
+
         # do we need to represent in MiB?
         mibsize = self.size / (1024.0 ** 2)
         if int(mibsize):
@@ -191,14 +309,835 @@ Erstellungsdatum: `{self.creation_date.strftime("%d.%m.%Y, %B")}`
 """
 
 
+def _parse_search_page(body: bytes) -> Optional[str]:
+    """ Returns the link to the first result on the "search packages" site. """
+    # imported only once needed, it takes a while and isn't needed with sync databases
+    import lxml.html
+    tree = lxml.html.parse(io.BytesIO(body))
+    element = tree.xpath("/html/body/div[2]/div[3]/table/tbody/tr/td[3]/a")
+    if not element:
+        return None
+    return element[0].get("href")
+
+
+def _parse_package_page(body: bytes) -> Package:
+    """ Builds a Package out of the meta tags on the site of a single package. """
+    import lxml.html
+    tree = lxml.html.parse(io.BytesIO(body))
+    name = tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[1]")[0].get("content")
+    version = tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[2]")[0].get("content")
+    size = int(tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[4]")[0].get("content"))
+    creation_date = datetime.date.fromisoformat(tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[5]")[0].get("content"))
+    publish_date = datetime.date.fromisoformat(tree.xpath("/html/body/div[2]/div[2]/div[2]/meta[6]")[0].get("content"))
+    return Package(name, version, size, creation_date, publish_date)
+
+
+class SyncIndex:
+    """
+    Name → version/size/build date of all packages in the pacman sync
+    databases (core.db, extra.db, ...) found in `path`. The databases are
+    plain (optionally gzip/bzip2/xz compressed) tarballs with one `desc` file
+    per package, which are streamed through without extracting anything.
+    """
+
+    def __init__(self, path: str = SYNC_DB_PATH, repos=SYNC_DB_REPOS):
+        self.path = path
+        self.repos = repos
+        self.packages = {}  # key is the name, value is (version, size, build timestamp)
+        self._mtimes = None
+
+    def __bool__(self):
+        return bool(self.packages)
+
+    def __len__(self):
+        return len(self.packages)
+
+    def get(self, name: str) -> Optional[Package]:
+        entry = self.packages.get(name)
+        if entry is None:
+            return None
+        version, size, build_date = entry
+        date = datetime.date.fromtimestamp(build_date)
+        return Package(name, version, size, date, date)
+
+    def db_files(self) -> list:
+        files = []
+        for repo in self.repos:
+            path = os.path.join(self.path, f"{repo}.db")
+            if os.path.isfile(path):
+                files.append(path)
+        return files
+
+    async def refresh(self) -> bool:
+        """
+        Reloads the index if any database changed since the last load. The new
+        index is built in an executor and swapped in at once, so lookups never
+        see a half-loaded index. Returns whether something was reloaded.
+        """
+        files = self.db_files()
+        mtimes = {path: os.stat(path).st_mtime_ns for path in files}
+        if mtimes == self._mtimes:
+            return False
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        packages = await loop.run_in_executor(None, _load_sync_dbs, files)
+        self.packages = packages
+        self._mtimes = mtimes
+        await name_index.update(packages.keys())
+        logging.info(
+            f"Loaded {len(packages)} packages from {len(files)} sync databases "
+            f"in {time.perf_counter() - started:.2f} s")
+        return True
+
+    async def watch(self):
+        """ Keeps the index up to date with the databases on disk. """
+        while True:
+            try:
+                await self.refresh()
+            except (OSError, tarfile.TarError) as e:
+                logging.warning(f"Loading the sync databases failed: {e!r}")
+            await asyncio.sleep(SYNC_DB_CHECK_INTERVAL)
+
+
+def _load_sync_dbs(files: list) -> dict:
+    packages = {}
+    for path in files:
+        # "r|*" streams through the archive instead of seeking around in it
+        with tarfile.open(path, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith("/desc"):
+                    continue
+                entry = _parse_desc(tar.extractfile(member).read().decode())
+                if entry is not None:
+                    packages[entry[0]] = entry[1:]
+    return packages
+
+
+def _parse_desc(desc: str) -> Optional[tuple]:
+    """ Returns (name, version, size, build timestamp) from a `desc` file. """
+    fields = {}
+    key = None
+    for line in desc.splitlines():
+        if line.startswith("%") and line.endswith("%"):
+            key = line
+        elif line and key is not None and key not in fields:
+            fields[key] = line
+    try:
+        return (
+            sys.intern(fields["%NAME%"]),
+            sys.intern(fields["%VERSION%"]),
+            int(fields.get("%ISIZE%", 0)),
+            int(fields["%BUILDDATE%"]))
+    except (KeyError, ValueError):
+        return None
+
+
+def _trigrams(word: str) -> set:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def _short_grams(word: str) -> set:
+    """ All substrings of one or two characters. """
+    return set(word) | {word[i:i + 2] for i in range(len(word) - 1)}
+
+
+class NameIndex:
+    """
+    Prefix and trigram index over all known package names, used by search
+    and for suggestions when lookup doesn't find a package.
+
+    Names are indexed padded as "  name ", so that prefixes and short names
+    still share some trigrams. Terms too short for trigrams are looked up in
+    a separate index of all substrings of one or two characters.
+    """
+
+    def __init__(self):
+        self._names = set()
+        self._sorted = []  # all names, sorted, for prefix search
+        self._trigrams = collections.defaultdict(set)  # key is a trigram, value the names with it
+        # key is a substring of one or two characters, value the (length, name) of the names with it, sorted
+        self._short = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name: str):
+        if name in self._names:
+            return
+        self._names.add(name)
+        bisect.insort(self._sorted, name)
+        for trigram in _trigrams(f"  {name} "):
+            self._trigrams[trigram].add(name)
+        key = (len(name), name)
+        for gram in _short_grams(name):
+            bisect.insort(self._short[gram], key)
+
+    def remove(self, name: str):
+        if name not in self._names:
+            return
+        self._names.remove(name)
+        del self._sorted[bisect.bisect_left(self._sorted, name)]
+        for trigram in _trigrams(f"  {name} "):
+            names = self._trigrams[trigram]
+            names.discard(name)
+            if not names:
+                del self._trigrams[trigram]
+        key = (len(name), name)
+        for gram in _short_grams(name):
+            keys = self._short[gram]
+            del keys[bisect.bisect_left(keys, key)]
+            if not keys:
+                del self._short[gram]
+
+    async def update(self, names):
+        """
+        Makes the index contain exactly the given names. Small changes are
+        applied incrementally, a (re)build from scratch happens in an executor.
+        """
+        names = set(names)
+        added = names - self._names
+        removed = self._names - names
+        if len(added) + len(removed) < 1000:
+            for name in removed:
+                self.remove(name)
+            for name in added:
+                self.add(name)
+            return
+
+        loop = asyncio.get_running_loop()
+        fresh = await loop.run_in_executor(None, NameIndex._build, names)
+        self._names, self._sorted, self._trigrams, self._short = \
+            fresh._names, fresh._sorted, fresh._trigrams, fresh._short
+
+    @staticmethod
+    def _build(names: set) -> "NameIndex":
+        index = NameIndex()
+        index._names = names
+        index._sorted = sorted(names)
+        for name in names:
+            for trigram in _trigrams(f"  {name} "):
+                index._trigrams[trigram].add(name)
+            key = (len(name), name)
+            for gram in _short_grams(name):
+                index._short[gram].append(key)
+        for keys in index._short.values():
+            keys.sort()
+        return index
+
+    def prefix(self, term: str, limit: int) -> list:
+        """ Returns up to limit names starting with term, in sorted order. """
+        start = bisect.bisect_left(self._sorted, term)
+        results = []
+        for name in self._sorted[start:start + limit]:
+            if not name.startswith(term):
+                break
+            results.append(name)
+        return results
+
+    def search(self, term: str, limit: int) -> list:
+        """
+        Returns up to limit names containing term, the ones starting with it
+        first, then the shortest ones.
+        """
+        results = self.prefix(term, limit)
+        if len(results) >= limit:
+            return results
+
+        found = set(results)
+        if len(term) < 3:
+            # already in the order wanted, shortest first
+            matches = (name for _, name in self._short.get(term, ()) if name not in found)
+            return results + list(itertools.islice(matches, limit - len(results)))
+
+        # start intersecting with the rarest trigram to keep the sets small
+        sets = sorted((self._trigrams.get(trigram, set()) for trigram in _trigrams(term)), key=len)
+        candidates = set(sets[0]).intersection(*sets[1:])
+        matches = (name for name in candidates if term in name and name not in found)
+        return results + heapq.nsmallest(limit - len(results), matches, key=lambda name: (len(name), name))
+
+    def fuzzy(self, term: str, limit: int) -> list:
+        """ Returns up to limit names most similar to term, the best first. """
+        trigrams = _trigrams(f"  {term} ")
+        shared = collections.Counter()
+        for trigram in trigrams:
+            shared.update(self._trigrams.get(trigram, ()))
+
+        def similarity(item):
+            name, count = item
+            # jaccard similarity of the trigram sets
+            return count / (len(trigrams) + len(name) + 1 - count)
+
+        best = heapq.nlargest(limit, shared.items(), key=similarity)
+        return [name for name, _ in best]
+
+
+class PackageLookupFailed(Exception):
+    """ archlinux.org couldn't be reached or answered with an error. """
+
+
+class LookupClient:
+    """
+    Fetches pages from archlinux.org without blocking the event loop. All
+    lookups share one pooled session, and parsing the (rather large) HTML is
+    done in an executor.
+    """
+
+    def __init__(self, concurrency: int = LOOKUP_CONCURRENCY, timeout: float = LOOKUP_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+
+    def session(self) -> aiohttp.ClientSession:
+        # created lazily, since a session needs a running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def get(self, url: str, **kwargs) -> Optional[bytes]:
+        """
+        Returns the body of the given URL, or None if it doesn't exist. Raises
+        PackageLookupFailed on any other error, so a hiccup of archlinux.org
+        isn't mistaken (and cached) as a package not existing.
+        """
+        session = self.session()
+        host = urllib.parse.urlsplit(url).hostname
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                async with session.get(url, **kwargs) as response:
+                    if response.status == 404:
+                        return None
+                    if response.status != 200:
+                        metrics.count("archer_lookup_failures_total", host=host)
+                        raise PackageLookupFailed(f"{url} returned {response.status}")
+                    return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.count("archer_lookup_failures_total", host=host)
+                logging.warning(f"Fetching {url} failed: {e!r}")
+                raise PackageLookupFailed(f"{url} couldn't be fetched") from e
+            finally:
+                metrics.observe("archer_lookup_request_seconds", time.perf_counter() - started, host=host)
+
+    async def parse(self, parser, body: bytes):
+        """ Runs the given parser on the body in the default executor. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, parser, body)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class AurClient:
+    """
+    Looks up packages in the AUR through its RPC interface. Names asked for
+    within AUR_BATCH_DELAY of each other are sent as one `info` request with
+    multiple `arg[]`, and results go through the same LookupCache (with keys
+    prefixed by "aur/") and pooled session as the official repositories.
+    """
+
+    def __init__(self):
+        self._pending = {}  # key is the name, value is the future waiting for it
+        self._flush_handle = None
+
+    async def by_name(self, name: str) -> Optional[Package]:
+        return await lookup_cache.get(f"aur/{name.lower()}", self._fetch)
+
+    async def _fetch(self, key: str) -> Optional[Package]:
+        name = key[len("aur/"):]
+        future = self._pending.get(name)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[name] = future
+            if self._flush_handle is None:
+                self._flush_handle = loop.call_later(AUR_BATCH_DELAY, self._flush)
+        return await future
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        self._flush_handle = None
+        names = list(pending)
+        for start in range(0, len(names), AUR_BATCH_SIZE):
+            batch = {name: pending[name] for name in names[start:start + AUR_BATCH_SIZE]}
+            asyncio.ensure_future(self._info(batch))
+
+    async def _info(self, batch: dict):
+        params = [("v", "5"), ("type", "info")] + [("arg[]", name) for name in batch]
+        try:
+            body = await lookup_client.get(f"{AUR_URL}/rpc/", params=params)
+            response = json.loads(body) if body is not None else {}
+            if not isinstance(response, dict) or response.get("type") != "multiinfo":
+                error = response.get("error") if isinstance(response, dict) else response
+                raise PackageLookupFailed(f"AUR RPC answered with {error!r}")
+            found = {result["Name"].lower(): result for result in response["results"]}
+            packages = {name: _aur_package(found.get(name)) for name in batch}
+        except Exception as e:
+            # nobody else would ever finish the lookups waiting for this batch
+            reason = str(e) if isinstance(e, PackageLookupFailed) else f"AUR RPC answer not understood: {e!r}"
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(PackageLookupFailed(reason))
+            return
+
+        for name, future in batch.items():
+            if not future.done():
+                future.set_result(packages[name])
+
+
+def _aur_package(result: Optional[dict]) -> Optional[Package]:
+    if result is None:
+        return None
+    return Package(
+        result["Name"],
+        result["Version"],
+        None,
+        datetime.date.fromtimestamp(result["LastModified"]),
+        datetime.date.fromtimestamp(result["FirstSubmitted"]),
+        aur=True)
+
+
+class LookupCache:
+    """
+    Remembers the results of recent lookups, including the ones that didn't
+    find anything. Once full, the least recently used entry is evicted.
+
+    Expired entries are still served for `stale` more seconds while they are
+    refreshed in the background, and concurrent lookups of the same key share
+    one fetch.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = LOOKUP_CACHE_SIZE,
+            ttl: float = LOOKUP_CACHE_TTL,
+            negative_ttl: float = LOOKUP_CACHE_NEGATIVE_TTL,
+            stale: float = LOOKUP_CACHE_STALE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale = stale
+        self._entries = collections.OrderedDict()  # key is the name, value is (result, expiry)
+        self._inflight = {}  # key is the name, value is the task fetching it
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key, fetch):
+        """
+        Returns the cached value for key, calling the coroutine function
+        `fetch(key)` if there is none yet.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expiry = entry
+            now = time.monotonic()
+            if now < expiry:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            if now < expiry + self.stale:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                if key not in self._inflight:
+                    self._start_fetch(key, fetch)
+                return value
+            del self._entries[key]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = self._start_fetch(key, fetch)
+        else:
+            self.coalesced += 1
+        # shielded so one impatient caller can't cancel the fetch for everyone
+        return await asyncio.shield(task)
+
+    def peek(self, key):
+        """ Returns (True, value) if key is cached and fresh, else (False, None). """
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry[1]:
+            return False, None
+        return True, entry[0]
+
+    def put(self, key, value):
+        ttl = self.negative_ttl if value is None else self.ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> str:
+        return f"{self.hits} Treffer, {self.stale_hits} veraltet, {self.misses} Fehlschläge, " \
+            f"{self.coalesced} zusammengelegt, {len(self)}/{self.max_entries} Einträge"
+
+    def _start_fetch(self, key, fetch) -> asyncio.Task:
+        task = asyncio.ensure_future(fetch(key))
+        self._inflight[key] = task
+        task.add_done_callback(lambda task: self._fetched(key, task))
+        return task
+
+    def _fetched(self, key, task: asyncio.Task):
+        del self._inflight[key]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            # errors are not cached, a stale entry stays until the next try
+            logging.warning(f"Looking up {key} failed: {task.exception()!r}")
+            return
+        self.put(key, task.result())
+
+
+class SettingsStore:
+    """
+    Keeps the settings of all guilds in an SQLite database in WAL mode, so
+    one guild's settings can be loaded and saved without touching the others.
+
+    Saving is write-behind: changes are collected for SAVE_DELAY seconds and
+    then written together in one transaction on a separate thread, so a burst
+    of changes costs one disk write and never blocks the event loop.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY,
+            prefix TEXT NOT NULL,
+            mod_role INTEGER,
+            distraction_probability INTEGER NOT NULL
+        );
+        -- channel_id 0 holds the roles of a guild not assigned to any channel yet
+        CREATE TABLE IF NOT EXISTS role_menus (
+            guild_id INTEGER NOT NULL REFERENCES guilds (guild_id),
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER,
+            PRIMARY KEY (guild_id, channel_id)
+        );
+        CREATE TABLE IF NOT EXISTS reaction_roles (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            emoji_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, channel_id, emoji_id),
+            FOREIGN KEY (guild_id, channel_id) REFERENCES role_menus (guild_id, channel_id)
+        );
+    """
+
+    def __init__(self, path: str = DATABASE):
+        self.path = path
+        self._db = None  # for reading, on the event loop
+        self._writer = None  # for writing, only ever used on the executor's thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="settings-store")
+        self._dirty = {}  # key is the guild id, value the settings waiting to be written
+        self._writing = {}  # the same, but for the settings being written right now
+        self._flush_task = None
+        self._legacy_skipped = False  # whether not importing SAVEFILE was logged already
+        self.saves = 0
+        self.writes = 0
+
+    @property
+    def saves_coalesced(self) -> int:
+        """ How many writes were saved by collecting changes. """
+        return self.saves - self.writes - len(self._dirty) - len(self._writing)
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode = WAL")
+        # fsync on every commit, so a crash never leaves a half written transaction
+        db.execute("PRAGMA synchronous = FULL")
+        db.execute("PRAGMA foreign_keys = ON")
+        with db:
+            db.executescript(self.SCHEMA)
+        return db
+
+    def db(self) -> sqlite3.Connection:
+        # opened lazily, so merely importing this file doesn't create a database
+        if self._db is None:
+            self._db = self._connect()
+        return self._db
+
+    def load(self, guild_id: int) -> Optional[dict]:
+        """
+        Returns the settings of the given guild as dict, or None if there are
+        none saved yet.
+        """
+        # changes not written yet are newer than anything in the database
+        pending = self._dirty.get(guild_id, self._writing.get(guild_id))
+        if pending is not None:
+            return pending
+
+        as_dict = self._read(self.db(), [guild_id]).get(guild_id)
+        if as_dict is None:
+            return self._import_legacy([guild_id]).get(guild_id)
+        return as_dict
+
+    async def load_all(self, guild_ids) -> dict:
+        """
+        Like load, but for many guilds at once, read in one go on the writer's
+        thread. Returns {guild id: dict or None}.
+        """
+        guild_ids = list(guild_ids)
+        loop = asyncio.get_running_loop()
+        loaded = await loop.run_in_executor(self._executor, self._read_all, guild_ids)
+        for guild_id in guild_ids:
+            pending = self._dirty.get(guild_id, self._writing.get(guild_id))
+            if pending is not None:
+                loaded[guild_id] = pending
+        missing = [guild_id for guild_id in guild_ids if guild_id not in loaded]
+        # cheap as long as there is no legacy file, which is almost always
+        if missing and os.path.exists(SAVEFILE):
+            loaded.update(self._import_legacy(missing))
+        for guild_id in missing:
+            loaded.setdefault(guild_id, None)
+        return loaded
+
+    def _read_all(self, guild_ids: list) -> dict:
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._read(self._writer, guild_ids)
+
+    @staticmethod
+    def _read(db: sqlite3.Connection, guild_ids: list) -> dict:
+        """ Returns {guild id: settings as dict} of the given guilds which have settings saved. """
+        loaded = {}
+        # SQLite allows only so many parameters per statement
+        for start in range(0, len(guild_ids), 500):
+            chunk = guild_ids[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            for guild_id, prefix, mod_role, distraction_probability in db.execute(
+                    "SELECT guild_id, prefix, mod_role, distraction_probability FROM guilds "
+                    f"WHERE guild_id IN ({placeholders})", chunk):
+                loaded[guild_id] = {
+                    "prefix": prefix,
+                    "mod_role": mod_role,
+                    "distraction_probability": distraction_probability,
+                    "menus": {},  # turned into a list below
+                }
+            for guild_id, channel_id, message_id in db.execute(
+                    f"SELECT guild_id, channel_id, message_id FROM role_menus WHERE guild_id IN ({placeholders})",
+                    chunk):
+                loaded[guild_id]["menus"][channel_id] = {"channel": channel_id, "message": message_id, "roles": {}}
+            for guild_id, channel_id, emoji_id, role_id in db.execute(
+                    "SELECT guild_id, channel_id, emoji_id, role_id FROM reaction_roles "
+                    f"WHERE guild_id IN ({placeholders})", chunk):
+                loaded[guild_id]["menus"][channel_id]["roles"][str(emoji_id)] = role_id
+        for as_dict in loaded.values():
+            as_dict["menus"] = list(as_dict["menus"].values())
+        return loaded
+
+    def save(self, guild_id: int, as_dict: dict):
+        """
+        Schedules replacing all saved settings of the given guild. Needs to be
+        called from within the event loop.
+        """
+        self.saves += 1
+        self._dirty[guild_id] = as_dict
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def flush(self):
+        """ Writes all pending changes right now, and waits until they are. """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write_dirty()
+        # a write started earlier might still be running
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, lambda: None)
+
+    async def close(self):
+        await self.flush()
+        self._executor.shutdown(wait=True)
+
+    async def _flush_later(self):
+        await asyncio.sleep(SAVE_DELAY)
+        # from here on, the write itself must not be cancelled by flush
+        self._flush_task = None
+        await self._write_dirty()
+
+    async def _write_dirty(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        self._writing.update(batch)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._write, batch)
+            self.writes += len(batch)
+            if notifier is not None:
+                notifier.settings_written(batch)
+        except sqlite3.Error as e:
+            logging.error(f"Saving the settings of {len(batch)} guilds failed: {e!r}")
+            # try again later, unless there are even newer changes already
+            for guild_id, as_dict in batch.items():
+                self._dirty.setdefault(guild_id, as_dict)
+            if self._flush_task is None:
+                self._flush_task = asyncio.ensure_future(self._flush_later())
+        finally:
+            for guild_id, as_dict in batch.items():
+                if self._writing.get(guild_id) is as_dict:
+                    del self._writing[guild_id]
+
+    def _write(self, batch: dict):
+        if self._writer is None:
+            self._writer = self._connect()
+        with self._writer as db:
+            for guild_id, as_dict in batch.items():
+                self._replace(db, guild_id, as_dict)
+
+    @staticmethod
+    def _replace(db: sqlite3.Connection, guild_id: int, as_dict: dict):
+        db.execute(
+            "INSERT OR REPLACE INTO guilds (guild_id, prefix, mod_role, distraction_probability) "
+            "VALUES (?, ?, ?, ?)",
+            (guild_id, as_dict["prefix"], as_dict["mod_role"], as_dict["distraction_probability"]))
+        db.execute("DELETE FROM reaction_roles WHERE guild_id = ?", (guild_id,))
+        db.execute("DELETE FROM role_menus WHERE guild_id = ?", (guild_id,))
+        for menu in as_dict["menus"]:
+            db.execute(
+                "INSERT INTO role_menus (guild_id, channel_id, message_id) VALUES (?, ?, ?)",
+                (guild_id, menu["channel"], menu["message"]))
+            db.executemany(
+                "INSERT INTO reaction_roles (guild_id, channel_id, emoji_id, role_id) VALUES (?, ?, ?, ?)",
+                ((guild_id, menu["channel"], int(emoji), role) for emoji, role in menu["roles"].items()))
+
+    def _import_legacy(self, guild_ids: list) -> dict:
+        """
+        Takes over the settings file of older versions, which only knew one
+        guild, if one of the given guilds is the one its channel and roles
+        belong to. Returns {guild id: settings as dict} of that guild, if any.
+        """
+        try:
+            with open(SAVEFILE) as fh:
+                as_dict = json.loads(fh.read())
+        except (OSError, ValueError):
+            # it probably just doesn't exist
+            return {}
+        if not isinstance(as_dict, dict):
+            return {}
+
+        guilds = [guild for guild in map(client.get_guild, guild_ids) if guild is not None]
+        owner = next((guild for guild in guilds if _owns_legacy_settings(guild, as_dict)), None)
+        if owner is None and WORKERS == 1 and len(client.guilds) == 1 and client.guilds[0].id in guild_ids:
+            # nothing to recognize the guild by, but with only one it's clear anyway
+            owner = client.guilds[0]
+        if owner is None:
+            if not self._legacy_skipped:
+                self._legacy_skipped = True
+                logging.warning(f"{SAVEFILE} from an older version belongs to none of the guilds, not importing it")
+            return {}
+        guild_id = owner.id
+        try:
+            # renamed first, so only one worker process takes it over
+            os.rename(SAVEFILE, f"{SAVEFILE}.imported")
+        except OSError:
+            return {}
+
+        menu = {
+            "channel": as_dict.get("roles_channel", None) or 0,
+            "message": as_dict.get("roles_msg", None),
+            "roles": as_dict.get("roles", {}),
+        }
+        as_dict = {
+            "prefix": as_dict.get("prefix", "archer "),
+            "mod_role": as_dict.get("mod_role", None),
+            "distraction_probability": as_dict.get("distraction_probability", 100),
+            "menus": [menu] if menu["channel"] or menu["roles"] else [],
+        }
+        # written right away, since the old file is gone already
+        with self.db() as db:
+            self._replace(db, guild_id, as_dict)
+        logging.info(f"Imported the old settings file for guild {guild_id}")
+        return {guild_id: as_dict}
+
+
+def _owns_legacy_settings(guild: discord.Guild, as_dict: dict) -> bool:
+    """ Whether the settings file of older versions was written for the given guild. """
+    if as_dict.get("roles_channel") and guild.get_channel(as_dict["roles_channel"]) is not None:
+        return True
+    role_ids = [as_dict.get("mod_role")] + list((as_dict.get("roles") or {}).values())
+    return any(role_id and guild.get_role(role_id) is not None for role_id in role_ids)
+
+
+class RoleMenu:
+    """
+    A message whose reactions give roles, one per channel at most.
+
+    The message itself is only referenced through a PartialMessage, which
+    needs no request to discord. Its content is tracked through the gateway
+    (see on_raw_message_edit), so it's only edited if that's actually needed.
+    """
+
+    def __init__(self, channel_id: int, message_id: Optional[int] = None, roles: Optional[dict] = None):
+        # 0 for a menu whose channel isn't known yet, see send_role_message
+        self.channel_id = channel_id
+        self.message_id = message_id  # None until it is sent
+        self.roles = roles if roles is not None else {}  # key is the reaction emoji id, value is the role
+        self.content = None  # what the message currently says, if known
+        self.edit_task = None
+        self._version = 0  # changed whenever roles are changed
+        self._rendered = (None, None)  # (version, content)
+        self._handle = None
+
+    def link(self, emoji_id: str, role: discord.Role):
+        self.roles[emoji_id] = role
+        self._version += 1
+
+    def unlink(self, emoji_id: str):
+        del self.roles[emoji_id]
+        self._version += 1
+
+    def sent(self, message: discord.Message):
+        """ Takes the given message as the new menu message. """
+        self.message_id = message.id
+        self.content = message.content
+        self._handle = None
+
+    def deleted(self):
+        self.message_id = None
+        self.content = None
+        self._handle = None
+
+    def message(self) -> Optional[discord.PartialMessage]:
+        """ The menu message, None if it was deleted along with its channel. """
+        if self._handle is None or self._handle.id != self.message_id:
+            channel = client.get_channel(self.channel_id)
+            if channel is None:
+                logging.info(f"The channel {self.channel_id} of a role menu was deleted")
+                self.deleted()
+                return None
+            self._handle = channel.get_partial_message(self.message_id)
+        return self._handle
+
+    def render(self) -> str:
+        version, content = self._rendered
+        if version != self._version:
+            content = f"{MENU_HEADER}\n{pretty_role_emoji_assoc(self)}"
+            self._rendered = (self._version, content)
+        return content
+
+
 class Settings:
-    prefix = "archer "
-    roles_msg = None  # the message where roles are given by reactions
-    roles_channel = None  # the channel where the message is in
-    mod_role = None
-    roles = {}  # key is the reaction emoji, value is the role
-    distraction_probability = 100
-    loaded = False
+    """ The settings of a single guild. """
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.prefix = "archer "
+        self.mod_role = None
+        self.menus = {}  # key is the channel id, value is the RoleMenu in there
+        self.distraction_probability = 100
 
     def save(self):
         if self.mod_role is None:
@@ -207,116 +1146,1413 @@ class Settings:
             mod_role = self.mod_role.id
         as_dict = {
             "prefix": self.prefix,
-            "roles_msg": self.roles_msg,
-            "roles_channel": self.roles_channel,
             "mod_role": mod_role,
             "distraction_probability": self.distraction_probability,
-            "roles": {emoji: role.id for emoji, role in self.roles.items()},
+            "menus": [{
+                "channel": menu.channel_id,
+                "message": menu.message_id,
+                "roles": {emoji: role.id for emoji, role in menu.roles.items() if role is not None},
+            } for menu in self.menus.values()],
         }
-        with open(SAVEFILE, "w") as fh:
-            fh.write(json.dumps(as_dict))
+        settings_store.save(self.guild_id, as_dict)
+        index_menus(self)
 
     def load(self, guild: discord.Guild):
-        """ Load the settings from our settings-file. """
-        try:
-            with open(SAVEFILE) as fh:
-                as_dict = json.loads(fh.read())
+        """ Load the settings from the settings store. """
+        self.apply(guild, settings_store.load(guild.id))
 
-            self.prefix = as_dict.get("prefix", "archer ")
-            self.roles_msg = as_dict.get("roles_msg", None)
-            self.roles_channel = as_dict.get("roles_channel", None)
+    def apply(self, guild: discord.Guild, as_dict: Optional[dict]):
+        """ Takes over settings as loaded by SettingsStore, None for the defaults. """
+        if as_dict is not None:
+            self.prefix = as_dict["prefix"]
 
-            if as_dict.get("mod_role", None):
+            if as_dict["mod_role"]:
                 self.mod_role = guild.get_role(as_dict["mod_role"])
             else:
                 self.mod_role = None
 
-            self.distraction_probability = as_dict.get(
-                "distraction_probability", 100)
-            self.roles = {emoji: guild.get_role(
-                role) for emoji, role in as_dict.get("roles", {}).items()}
-        except:
-            # it probably just doesn't exist yet
-            pass
-        self.loaded = True
+            self.distraction_probability = as_dict["distraction_probability"]
+            self.menus = {menu["channel"]: RoleMenu(
+                menu["channel"],
+                menu["message"],
+                {emoji: guild.get_role(role) for emoji, role in menu["roles"].items()},
+            ) for menu in as_dict["menus"]}
+        index_menus(self)
+
+    def menu_by_message(self, message_id: int) -> Optional[RoleMenu]:
+        for menu in self.menus.values():
+            if menu.message_id == message_id:
+                return menu
+        return None
+
+
+menu_index = {}  # key is (message id, emoji id), value is the role id, over all guilds
+_menu_index_keys = {}  # key is the guild id, value is its keys in menu_index
+
+
+def index_menus(settings: Settings):
+    """ Updates menu_index with the role menus of the given guild. """
+    for key in _menu_index_keys.pop(settings.guild_id, ()):
+        del menu_index[key]
+
+    keys = set()
+    for menu in settings.menus.values():
+        if menu.message_id is None:
+            continue
+        for emoji_id, role in menu.roles.items():
+            if role is None:
+                # the role was deleted
+                continue
+            key = (menu.message_id, int(emoji_id))
+            menu_index[key] = role.id
+            keys.add(key)
+    _menu_index_keys[settings.guild_id] = keys
+
+
+def menu_role(message_id: int, emoji_id: Optional[int]) -> Optional[int]:
+    """ Returns the id of the role given by reacting with the emoji on the message, if any. """
+    # all guilds are indexed before any reaction is handled, see warm_up
+    return menu_index.get((message_id, emoji_id))
+
+
+# the settings of all guilds stay in memory, their role menus are needed for every reaction anyway
+_settings_cache = {}  # key is the guild id, value its Settings
+
+
+def guild_settings(guild: discord.Guild) -> Settings:
+    """ Returns the settings of the given guild, loading them on first use. """
+    settings = _settings_cache.get(guild.id)
+    if settings is None:
+        settings = Settings(guild.id)
+        settings.load(guild)
+        _settings_cache[guild.id] = settings
+    return settings
+
+
+async def warm_up(guilds: list):
+    """
+    Loads the settings of all given guilds at once, indexing all of their
+    role menus and preparing their messages and emojis. Guilds which are
+    unavailable right now are left for on_guild_available.
+    """
+    loaded = await settings_store.load_all(guild.id for guild in guilds)
+    for guild in guilds:
+        # checked only now, some might have become available while loading
+        if guild.unavailable:
+            continue
+        try:
+            settings = _settings_cache.get(guild.id)
+            if settings is None:
+                settings = Settings(guild.id)
+                settings.apply(guild, loaded[guild.id])
+                _settings_cache[guild.id] = settings
+            for menu in settings.menus.values():
+                if menu.message_id is not None and client.get_channel(menu.channel_id) is not None:
+                    menu.message()
+                menu.render()
+        except Exception as e:
+            # one broken guild must not keep the role menus of all others from working
+            logging.error(f"Loading the settings of {guild} failed: {e!r}")
+
+
+def forget_settings(guild_id: int):
+    """ Drops everything known about the settings of a guild and loads them again. """
+    _settings_cache.pop(guild_id, None)
+    for key in _menu_index_keys.pop(guild_id, ()):
+        del menu_index[key]
+    forget_mod_perms(guild_id)
+    guild = client.get_guild(guild_id)
+    if guild is not None:
+        # the menu index has to know all menus, see menu_role
+        guild_settings(guild)
+
+
+class RoleUpdateQueue:
+    """
+    Collects the reaction role changes of each member for ROLE_UPDATE_WINDOW
+    seconds and then applies them together as one role update. Adding and
+    removing the same role within that window cancels out.
+
+    Since every update overwrites all roles of the member, the updates of a
+    member are applied one after another, each based on the roles the one
+    before has set.
+    """
+
+    def __init__(self, window: float = ROLE_UPDATE_WINDOW):
+        self.window = window
+        self._pending = {}  # key is (guild id, member id), value is {role id: (role, wanted)}
+        self._locks = {}  # same key, value is [lock, how many updates are using it]
+        # same key, value is ({role id: (role, wanted)}, when) of the roles changed lately, until discord confirms them
+        self._written = collections.OrderedDict()
+        self._watchers = []  # {key: {role id}} of live changes, one for each running reconciliation
+        self._semaphore = None
+        self.applied = 0
+        self.cancelled = 0
+        self.rate_limited = 0
+
+    def __len__(self):
+        """ How many members are waiting for their roles to be updated. """
+        return len(self._pending)
+
+    def add(self, member: discord.Member, role: discord.Role):
+        self._change(member, role, True)
+
+    def remove(self, member: discord.Member, role: discord.Role):
+        self._change(member, role, False)
+
+    def stats(self) -> str:
+        return f"{len(self)} ausstehend, {self.applied} angewendet, " \
+            f"{self.cancelled} aufgehoben, {self.rate_limited} Mal ausgebremst"
+
+    def watch(self) -> dict:
+        """ Collects which roles of which members are changed live from now on, until unwatch. """
+        watcher = collections.defaultdict(set)
+        self._watchers.append(watcher)
+        return watcher
+
+    def unwatch(self, watcher: dict):
+        self._watchers.remove(watcher)
+
+    def _change(self, member: discord.Member, role: discord.Role, wanted: bool):
+        key = (member.guild.id, member.id)
+        for watcher in self._watchers:
+            watcher[key].add(role.id)
+        changes = self._pending.get(key)
+        if changes is None:
+            changes = self._pending[key] = {}
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.window, lambda: asyncio.ensure_future(self._apply(key, member)))
+        # only the last change of a role counts
+        changes[role.id] = (role, wanted)
+
+    async def _apply(self, key: tuple, member: discord.Member):
+        await self.update(member, self._pending.pop(key))
+
+    async def update(self, member: discord.Member, changes: dict, watcher: Optional[dict] = None):
+        """
+        Applies the given changes ({role id: (role, wanted)}) to the member's
+        roles in one request, at most ROLE_UPDATE_CONCURRENCY at once, and
+        after any other update of the same member.
+
+        Changes found by reconciliation pass the watcher they got from watch:
+        live changes of the same roles since then are newer and win over them.
+        """
+        key = (member.guild.id, member.id)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if watcher is not None and key in watcher:
+                    live = watcher[key]
+                    changes = {role_id: change for role_id, change in changes.items() if role_id not in live}
+                if self._semaphore is None:
+                    self._semaphore = asyncio.Semaphore(ROLE_UPDATE_CONCURRENCY)
+                async with self._semaphore:
+                    await self._update(key, member, changes)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def confirm(self, member: discord.Member):
+        """ Forgets the changes of the member's roles which discord has applied, see on_member_update. """
+        key = (member.guild.id, member.id)
+        written = self._written.get(key)
+        if written is None:
+            return
+        role_ids = {role.id for role in member.roles}
+        changes = written[0]
+        for role_id, (role, wanted) in list(changes.items()):
+            if (role_id in role_ids) == wanted:
+                del changes[role_id]
+        if not changes:
+            del self._written[key]
+
+    def _current_roles(self, key: tuple, member: discord.Member) -> dict:
+        """ The roles the member has as far as we know, {role id: role}. """
+        now = time.monotonic()
+        while self._written and next(iter(self._written.values()))[1] < now - ROLE_UPDATE_MEMORY:
+            self._written.popitem(last=False)
+        # the default role (@everyone) can't be set explicitly
+        current = {role.id: role for role in member.roles if not role.is_default()}
+        if key in self._written:
+            # the member update from discord might not have arrived yet, but
+            # anything else changed in the meantime is up to date already
+            for role_id, (role, wanted) in self._written[key][0].items():
+                if wanted:
+                    current[role_id] = role
+                else:
+                    current.pop(role_id, None)
+        return current
+
+    async def _update(self, key: tuple, member: discord.Member, changes: dict):
+        # the roles are overwritten as a whole, so they need to be up to date
+        if LEAN_MEMBER_CACHE:
+            member = await members.fetch(member.guild, member.id) or member
+        else:
+            member = member.guild.get_member(member.id) or member
+
+        current = self._current_roles(key, member)
+        wanted = dict(current)
+        for role_id, (role, add) in changes.items():
+            if add:
+                wanted[role_id] = role
+            else:
+                wanted.pop(role_id, None)
+        if wanted.keys() == current.keys():
+            self.cancelled += 1
+            return
+
+        for attempt in range(ROLE_UPDATE_RETRIES):
+            try:
+                await scheduler.submit(
+                    PRIORITY_ROLES, member.edit,
+                    roles=list(wanted.values()), reason="Automatically through Reaction Roles")
+                self.applied += 1
+                written = self._written.pop(key, ({}, None))[0]
+                written.update(changes)
+                self._written[key] = (written, time.monotonic())
+                return
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == ROLE_UPDATE_RETRIES - 1:
+                    logging.error(f"Updating the roles of {member} failed: {e!r}")
+                    return
+                self.rate_limited += 1
+                await asyncio.sleep(2 ** attempt)
+
+
+class MemberCache:
+    """
+    In lean mode, discord.py keeps no members in memory. Instead, the
+    members who recently interacted with Archer are kept here, up to
+    MEMBER_CACHE_SIZE of them for MEMBER_CACHE_TTL seconds each, and anybody
+    else is fetched on demand.
+    """
+
+    def __init__(self, size: int = MEMBER_CACHE_SIZE, ttl: float = MEMBER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._members = collections.OrderedDict()  # key is (guild id, member id), value is (member, expiry)
+        self.fetches = 0
+
+    def put(self, member: discord.Member):
+        key = (member.guild.id, member.id)
+        self._members[key] = (member, time.monotonic() + self.ttl)
+        self._members.move_to_end(key)
+        while len(self._members) > self.size:
+            self._members.popitem(last=False)
+
+    async def get(self, guild: discord.Guild, member_id: int) -> Optional[discord.Member]:
+        member = guild.get_member(member_id)
+        if member is not None:
+            return member
+        entry = self._members.get((guild.id, member_id))
+        if entry is not None and time.monotonic() < entry[1]:
+            self._members.move_to_end((guild.id, member_id))
+            return entry[0]
+        return await self.fetch(guild, member_id)
+
+    async def fetch(self, guild: discord.Guild, member_id: int) -> Optional[discord.Member]:
+        """ Like get, but always asks discord. """
+        self.fetches += 1
+        try:
+            member = await guild.fetch_member(member_id)
+        except discord.NotFound:
+            # left the guild in the meantime
+            return None
+        self.put(member)
+        return member
+
+
+async def stream_role_holders(guild: discord.Guild, role_ids, wanted_ids: set) -> tuple:
+    """
+    Goes through the whole member list of the guild once, for when it isn't
+    in memory. Returns ({role id: ids of members having it}, {member id:
+    member}), the latter only for members in wanted_ids.
+    """
+    role_ids = set(role_ids)
+    holders = collections.defaultdict(set)
+    known = {}
+    async for member in guild.fetch_members(limit=None):
+        having = role_ids.intersection(role.id for role in member.roles)
+        for role_id in having:
+            holders[role_id].add(member.id)
+        if member.id in wanted_ids:
+            known[member.id] = member
+    return holders, known
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        """ Takes a token if there is one. """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def rest_route(fn) -> tuple:
+    """
+    Roughly which of discord's rate limits the request fn(...) counts
+    against: they apply per kind of request and channel, or guild for
+    members. discord.py sends the requests of each one after another.
+    """
+    target = getattr(fn, "__self__", None)
+    if hasattr(target, "channel"):
+        # a message
+        major = target.channel.id
+    elif isinstance(target, discord.Member):
+        major = target.guild.id
+    else:
+        major = getattr(target, "id", None)
+    return fn.__name__, major
+
+
+class RestScheduler:
+    """
+    Sends requests to discord, one route (see rest_route) after another and
+    the most important first: role changes, then replies to commands, then
+    distractions. Distractions are also limited per channel and dropped
+    instead of queued once there's too much to do.
+
+    The rate limits of the routes are still handled by discord.py, this
+    only decides who gets to wait for them first, and routes don't wait for
+    each other. The global rate limit all routes share is kept here though:
+    the next request of each route waits for a slot within REST_GLOBAL_RATE,
+    and slots go to the most important ones first.
+    """
+
+    def __init__(self, rate: float = REST_GLOBAL_RATE):
+        self._queues = {}  # key is the route, value is the PriorityQueue of its requests
+        self._tasks = {}  # same key, value is the task sending them
+        self._order = itertools.count()  # keeps requests of the same priority in order
+        self._slots = TokenBucket(rate, rate)
+        self._waiting = []  # heap of (priority, order, future) of routes waiting for a slot
+        self._granting = None  # the task handing out slots while there are any waiting
+        self._buckets = {}  # key is the channel id, value its TokenBucket for distractions
+        self.queued = collections.Counter()  # key is the priority
+        self.sent = collections.Counter()
+        self.waited = collections.Counter()  # total seconds spent in the queue
+        self.max_wait = collections.Counter()
+        self.dropped = 0
+
+    def __len__(self):
+        return sum(self.queued.values())
+
+    async def submit(self, priority: int, fn, *args, **kwargs):
+        """ Queues the request fn(*args, **kwargs) and returns its result once sent. """
+        route = rest_route(fn)
+        queue = self._queues.get(route)
+        if queue is None:
+            queue = self._queues[route] = asyncio.PriorityQueue()
+            self._tasks[route] = asyncio.ensure_future(self._work(route, queue))
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((priority, next(self._order), time.monotonic(), fn, args, kwargs, future))
+        self.queued[priority] += 1
+        return await future
+
+    async def send(self, channel, content: str, priority: int = PRIORITY_REPLIES):
+        return await self.submit(priority, channel.send, content)
+
+    def allow_distraction(self, channel) -> bool:
+        """ Whether a distraction may be sent to the channel right now. """
+        if len(self) >= REST_SATURATION:
+            self.dropped += 1
+            return False
+        bucket = self._buckets.get(channel.id)
+        if bucket is None:
+            bucket = self._buckets[channel.id] = TokenBucket(DISTRACTION_RATE, DISTRACTION_BURST)
+        if not bucket.take():
+            self.dropped += 1
+            return False
+        return True
+
+    async def distract(self, channel, content: str) -> bool:
+        """ Sends a distraction, if that's fine right now. Returns whether it was sent. """
+        if not self.allow_distraction(channel):
+            return False
+        await self.send(channel, content, PRIORITY_DISTRACTIONS)
+        return True
+
+    def stats(self) -> str:
+        parts = []
+        for priority, name in PRIORITY_NAMES.items():
+            sent = self.sent[priority]
+            average = self.waited[priority] / sent if sent else 0
+            parts.append(
+                f"{name}: {self.queued[priority]} wartend, {sent} gesendet, "
+                f"⌀ {average * 1000:.0f} ms / max {self.max_wait[priority] * 1000:.0f} ms")
+        parts.append(f"{self.dropped} Ablenkungen verworfen")
+        return "; ".join(parts)
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._granting is not None:
+            self._granting.cancel()
+
+    async def _slot(self, priority: int):
+        """ Waits for a slot within the global rate limit. """
+        if not self._waiting and self._slots.take():
+            return
+        slot = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._order), slot))
+        if self._granting is None:
+            self._granting = asyncio.ensure_future(self._grant())
+        await slot
+
+    async def _grant(self):
+        try:
+            while self._waiting:
+                if self._waiting[0][2].done():
+                    # its route was cancelled
+                    heapq.heappop(self._waiting)
+                elif self._slots.take():
+                    heapq.heappop(self._waiting)[2].set_result(None)
+                else:
+                    await asyncio.sleep(1 / self._slots.rate)
+        finally:
+            self._granting = None
+
+    async def _work(self, route: tuple, queue: asyncio.PriorityQueue):
+        """ Sends the requests of the route until there are none left. """
+        try:
+            while not queue.empty():
+                priority, _, queued_at, fn, args, kwargs, future = queue.get_nowait()
+                if not future.cancelled():
+                    await self._slot(priority)
+                self.queued[priority] -= 1
+                waited = time.monotonic() - queued_at
+                self.waited[priority] += waited
+                self.max_wait[priority] = max(self.max_wait[priority], waited)
+                if future.cancelled():
+                    continue
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    if not future.cancelled():
+                        future.set_result(result)
+                self.sent[priority] += 1
+        finally:
+            del self._queues[route]
+            del self._tasks[route]
+
+
+async def reply(message: discord.Message, content: str):
+    """
+    Answers in the channel of the given message. While on_message handles
+    commands, the answer is only buffered until all commands have run.
+    """
+    buffer = reply_buffer.get()
+    if buffer is not None:
+        buffer.write(content)
+        return
+    await scheduler.send(message.channel, content)
+
+
+async def reconcile_reaction_roles():
+    """
+    Catches up on reactions added while the bot was offline, by comparing
+    who reacted on each role menu with who has the roles.
+
+    Roles are only ever given here, never taken: having a role without a
+    reaction on the current menu message might just as well mean it was
+    given by hand, or for a reaction on an earlier message of the menu.
+    """
+    for guild in client.guilds:
+        if guild.unavailable:
+            # its reactions can't be read anyway
+            continue
+        try:
+            await reconcile_guild(guild, guild_settings(guild))
+        except discord.HTTPException as e:
+            logging.error(f"Reconciling reaction roles on {guild} failed: {e!r}")
+
+
+async def reconcile_guild(guild: discord.Guild, settings: Settings):
+    # reactions from now on are handled live, and newer than anything found here
+    watcher = role_updates.watch()
+    try:
+        await _reconcile_guild(guild, settings, watcher)
+    finally:
+        role_updates.unwatch(watcher)
+
+
+async def _reconcile_guild(guild: discord.Guild, settings: Settings, watcher: dict):
+    started = time.perf_counter()
+
+    # a role might be given by several menus, so collect all reactors first
+    roles = {}  # key is the role id, value is the role
+    reactors = collections.defaultdict(set)  # key is the role id, value is who reacted for it
+    for menu in settings.menus.values():
+        if menu.message_id is None:
+            continue
+        try:
+            message = await reaction_roles_message(menu)
+        except discord.NotFound:
+            logging.info(f"The role menu in {menu.channel_id} was deleted")
+            menu.deleted()
+            message = None
+        if message is None:
+            settings.save()
+            continue
+        for reaction in message.reactions:
+            if isinstance(reaction.emoji, str):
+                continue
+            role = menu.roles.get(str(reaction.emoji.id))
+            if role is None:
+                continue
+            roles[role.id] = role
+            # pages through all reactors, 100 per request
+            async for user in reaction.users():
+                reactors[role.id].add(user.id)
+
+    if LEAN_MEMBER_CACHE:
+        holders, known = await stream_role_holders(guild, roles.keys(), set().union(*reactors.values()))
+        member_by_id = known.get
+    else:
+        holders = {role.id: {member.id for member in role.members} for role in roles.values()}
+        member_by_id = guild.get_member
+
+    changes = collections.defaultdict(dict)  # key is the member, value is {role id: (role, wanted)}
+    for role in roles.values():
+        for member_id in reactors[role.id] - holders[role.id]:
+            member = member_by_id(member_id)
+            if member is not None and member_id != client.user.id:
+                changes[member][role.id] = (role, True)
+
+    todo = list(changes.items())
+    if not todo:
+        return
+    logging.info(f"Reconciling reaction roles of {len(todo)} members on {guild}")
+    for start in range(0, len(todo), RECONCILE_BATCH_SIZE):
+        batch = todo[start:start + RECONCILE_BATCH_SIZE]
+        await asyncio.gather(*(role_updates.update(member, change, watcher) for member, change in batch))
+        logging.info(
+            f"Reconciled {start + len(batch)}/{len(todo)} members on {guild} "
+            f"after {time.perf_counter() - started:.1f} s")
+
+
+class Histogram:
+    """ Counts observations into LATENCY_BUCKETS, like a Prometheus histogram. """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is for everything above
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """ The upper bound of the bucket the q-quantile is in, inf if above all. """
+        if not self.count:
+            return float("nan")
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+    Counters and histograms about what Archer is doing, served in the
+    Prometheus text format (see serve) and summarized by show.
+
+    Most statistics are kept by the classes they're about anyway, e.g.
+    LookupCache or RestScheduler, and are only read out here when rendering.
+    """
+
+    # key is the name, value is (type, help)
+    DESCRIPTIONS = {
+        "archer_commands_total": ("counter", "Commands run, by command and outcome."),
+        "archer_command_seconds": ("histogram", "How long commands took, by command."),
+        "archer_reactions_total": ("counter", "Reaction events, by event and outcome."),
+        "archer_rest_requests_total": ("counter", "Requests to discord, by route and status."),
+        "archer_rest_request_seconds": ("histogram", "How long requests to discord took, by route."),
+        "archer_rest_rate_limited_total": ("counter", "Times discord answered 429, by route."),
+        "archer_lookup_request_seconds": ("histogram", "How long requests for lookups took, by host."),
+        "archer_lookup_failures_total": ("counter", "Requests for lookups which failed, by host."),
+        "archer_lookup_cache_total": ("counter", "Lookup cache accesses, by result."),
+        "archer_role_updates_total": ("counter", "Role updates, by outcome."),
+        "archer_rest_queue_length": ("gauge", "Requests queued in the RestScheduler, not sent yet."),
+        "archer_event_loop_lag_seconds": ("histogram", "How much later than planned the event loop woke up."),
+        "archer_gateway_latency_seconds": ("gauge", "Time between a heartbeat and its acknowledgement."),
+        "archer_log_records_dropped_total": ("counter", "Log records dropped since the log couldn't keep up."),
+    }
+
+    def __init__(self):
+        self.counters = collections.defaultdict(collections.Counter)  # key is the name, value is {labels: value}
+        self.histograms = collections.defaultdict(dict)  # key is the name, value is {labels: Histogram}
+        self.loop_lag = 0.0  # the last measured one
+        self._runner = None
+
+    def count(self, name: str, amount: float = 1, **labels):
+        self.counters[name][tuple(labels.items())] += amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(labels.items())
+        histogram = self.histograms[name].get(key)
+        if histogram is None:
+            histogram = self.histograms[name][key] = Histogram()
+        histogram.observe(value)
+
+    def total(self, name: str) -> float:
+        """ The sum of a counter or the count of a histogram over all labels. """
+        if name in self.histograms:
+            return sum(histogram.count for histogram in self.histograms[name].values())
+        return sum(self.counters[name].values())
+
+    def merged(self, name: str) -> Histogram:
+        """ The histogram with the given name over all labels. """
+        merged = Histogram()
+        for histogram in self.histograms[name].values():
+            merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+            merged.sum += histogram.sum
+            merged.count += histogram.count
+        return merged
+
+    def collect(self):
+        """ Reads out the statistics kept elsewhere. """
+        cache = self.counters["archer_lookup_cache_total"]
+        cache[(("result", "hit"),)] = lookup_cache.hits
+        cache[(("result", "stale"),)] = lookup_cache.stale_hits
+        cache[(("result", "miss"),)] = lookup_cache.misses
+        cache[(("result", "coalesced"),)] = lookup_cache.coalesced
+        updates = self.counters["archer_role_updates_total"]
+        updates[(("outcome", "applied"),)] = role_updates.applied
+        updates[(("outcome", "cancelled"),)] = role_updates.cancelled
+        updates[(("outcome", "rate_limited"),)] = role_updates.rate_limited
+        self.counters["archer_log_records_dropped_total"][()] = DroppingQueueHandler.dropped
+        gauges = {
+            "archer_rest_queue_length": len(scheduler),
+            "archer_gateway_latency_seconds": client.latency,
+        }
+        return gauges
+
+    def render(self) -> str:
+        gauges = self.collect()
+        lines = []
+        for name, (kind, help) in self.DESCRIPTIONS.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                lines.append(f"{name} {_prometheus_value(gauges[name])}")
+            elif kind == "counter":
+                for labels, value in sorted(self.counters[name].items()):
+                    lines.append(f"{name}{_prometheus_labels(labels)} {_prometheus_value(value)}")
+            else:
+                for labels, histogram in sorted(self.histograms[name].items()):
+                    seen = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        seen += count
+                        lines.append(f"{name}_bucket{_prometheus_labels(labels + (('le', bound),))} {seen}")
+                    lines.append(f"{name}_sum{_prometheus_labels(labels)} {_prometheus_value(histogram.sum)}")
+                    lines.append(f"{name}_count{_prometheus_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        commands = self.merged("archer_command_seconds")
+        requests = self.merged("archer_rest_request_seconds")
+        lookups = self.merged("archer_lookup_request_seconds")
+        lag = self.merged("archer_event_loop_lag_seconds")
+        return f"Befehle: {commands.count}, p99 ≤ {_milliseconds(commands.quantile(0.99))}; " \
+            f"Discord: {requests.count} Anfragen, p99 ≤ {_milliseconds(requests.quantile(0.99))}, " \
+            f"{self.total('archer_rest_rate_limited_total'):.0f}× 429; " \
+            f"archlinux.org: {lookups.count} Anfragen, p99 ≤ {_milliseconds(lookups.quantile(0.99))}; " \
+            f"Loop-Verzögerung: p99 ≤ {_milliseconds(lag.quantile(0.99))}; " \
+            f"Gateway: {_milliseconds(client.latency)}"
+
+    async def watch_loop(self, interval: float = LOOP_LAG_INTERVAL):
+        """ Measures how late the event loop wakes up, which is how long something blocked it. """
+        loop = asyncio.get_running_loop()
+        while True:
+            planned = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag = max(0.0, loop.time() - planned)
+            self.observe("archer_event_loop_lag_seconds", self.loop_lag)
+
+    async def serve(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        async def handle(request):
+            return aiohttp.web.Response(text=self.render(), content_type="text/plain")
+
+        app = aiohttp.web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def _prometheus_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def _prometheus_value(value: float) -> str:
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _milliseconds(seconds: float) -> str:
+    if seconds != seconds:  # NaN, nothing measured yet
+        return "–"
+    return "∞" if seconds == float("inf") else f"{seconds * 1000:.0f} ms"
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats every record as a JSON object on a line of its own, including the FIELDS given as extra. """
+
+    FIELDS = ("guild", "channel", "user", "command", "arguments", "event", "latency", "outcome", "sample_rate")
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if WORKER_INDEX >= 0:
+            entry["worker"] = WORKER_INDEX
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Puts records into a bounded queue, dropping (and counting) them if it is full instead of waiting. """
+
+    dropped = 0  # over all handlers
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatted by the listener's handler instead, on its thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Sends all log records through a queue to a thread writing them to
+    stderr, so a slow terminal or log driver never holds up the event loop.
+    The returned listener needs to be stopped to write the remaining ones.
+    """
+    sink = logging.StreamHandler()
+    if LOG_FORMAT == "text":
+        worker = f"worker {WORKER_INDEX}: " if WORKER_INDEX >= 0 else ""
+        sink.setFormatter(logging.Formatter(LOGFORMAT.replace("%(message)s", f"{worker}%(message)s")))
+    else:
+        sink.setFormatter(JsonFormatter())
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    listener = logging.handlers.QueueListener(handler.queue, sink)
+    listener.start()
+    return listener
+
+
+def log_sampled(message: str, **fields):
+    """ Logs only LOG_SAMPLE_RATE of these records, for things happening all the time. """
+    if random.random() < LOG_SAMPLE_RATE:
+        logging.info(message, extra=dict(fields, sample_rate=LOG_SAMPLE_RATE))
+
+
+class RateLimitCounter(logging.Handler):
+    """
+    Counts the 429s discord.py handles by itself, which it only tells about
+    by logging a warning with the rate limit bucket.
+    """
+
+    def emit(self, record: logging.LogRecord):
+        if record.msg.startswith("We are being rate limited"):
+            # the bucket is "channel id:guild id:path"
+            metrics.count("archer_rest_rate_limited_total", route=str(record.args[1]).split(":", 2)[-1])
+        elif record.msg.startswith("Global rate limit"):
+            metrics.count("archer_rest_rate_limited_total", route="global")
+
+
+class Profiler:
+    """
+    Profiles the event handlers in PROFILED_EVENTS and the commands, and
+    nothing else the process does, through cProfile. Since coroutines
+    interleave, the profiler is only enabled while one of their steps (from
+    one await to the next) is running, see profile.
+
+    Independently of that, every step taking longer than SLOW_CALLBACK_THRESHOLD
+    is logged, as it held up everything else in the meantime.
+    """
+
+    def __init__(self, slow_threshold: float = SLOW_CALLBACK_THRESHOLD):
+        self.slow_threshold = slow_threshold
+        self.running = False
+        self.started = None  # when the current or last profile was started
+        self.totals = collections.Counter()  # key is the handler or command, value is seconds on the event loop
+        self.runs = collections.Counter()
+        self._profile = None
+        self._depth = 0  # of profiled coroutines within each other
+        self._reported = False  # whether a nested coroutine already logged the current step as slow
+
+    def wanted(self) -> bool:
+        """ Whether coroutines need to go through profile at all. """
+        return self.running or self.slow_threshold > 0
+
+    def start(self):
+        self._profile = cProfile.Profile()
+        self.totals.clear()
+        self.runs.clear()
+        self.started = datetime.datetime.now()
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    @types.coroutine
+    def profile(self, coro, name: str, args: tuple):
+        """ Awaits the coroutine, measuring every one of its steps. """
+        self.runs[name] += 1
+        value, error = None, None
+        while True:
+            self._enter()
+            started = time.perf_counter()
+            try:
+                if error is None:
+                    future = coro.send(value)
+                else:
+                    future = coro.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self._leave(name, args, time.perf_counter() - started)
+            try:
+                value, error = (yield future), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+    def _enter(self):
+        if self._depth == 0 and self.running:
+            self._profile.enable()
+        self._depth += 1
+
+    def _leave(self, name: str, args: tuple, duration: float):
+        self._depth -= 1
+        if self._depth == 0 and self.running:
+            self._profile.disable()
+        # including the time of nested coroutines
+        self.totals[name] += duration
+        if 0 < self.slow_threshold < duration and not self._reported:
+            described = ", ".join(map(repr, args))
+            logging.warning(f"{name}({described[:200]}) held the event loop for {duration * 1000:.0f} ms")
+            self._reported = True
+        if self._depth == 0:
+            self._reported = False
+
+    def summary(self, top: int = 10) -> str:
+        return "\n".join(
+            f"{seconds * 1000:10.1f} ms {self.runs[name]:8}× {name}"
+            for name, seconds in self.totals.most_common(top))
+
+    async def dump(self, top: int = PROFILE_TOP) -> Optional[str]:
+        """
+        Writes the profile so far to PERSISTENT_PATH, once as text with the top
+        functions and the totals per handler and command, once for pstats.
+        Returns the path of the former, None if nothing was profiled yet.
+        """
+        if self._profile is None:
+            return None
+        try:
+            stats = pstats.Stats(self._profile)
+        except TypeError:
+            # started, but nothing ran since
+            return None
+        worker = f"-worker{WORKER_INDEX}" if WORKER_INDEX >= 0 else ""
+        path = os.path.join(PERSISTENT_PATH, f"profile-{datetime.datetime.now():%Y%m%d-%H%M%S}{worker}")
+        summary = self.summary(len(self.totals))
+        header = f"Profile since {self.started:%Y-%m-%d %H:%M:%S}\n\nTime on the event loop per handler and command:\n"
+
+        def write():
+            with open(f"{path}.txt", "w") as fh:
+                fh.write(f"{header}{summary}\n\n")
+                stats.stream = fh
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+            stats.dump_stats(f"{path}.pstats")
+
+        await asyncio.get_running_loop().run_in_executor(None, write)
+        return f"{path}.txt"
+
+
+class PeerNotifier(asyncio.DatagramProtocol):
+    """
+    Tells the other worker processes (see launch) whose settings were just
+    written, so they forget the ones they have in memory. The settings
+    themselves are shared through the database.
+
+    Notifications are single UDP datagrams on localhost, worker i listening
+    on port + i. Since every guild lives on exactly one shard, they're only
+    needed for the rare guild known to several workers, so a lost one isn't
+    worth acknowledging.
+    """
+
+    MAX_IDS = 1000  # guild ids per datagram, keeps it well below the size limit
+
+    def __init__(self, index: int, workers: int, port: int = NOTIFY_PORT):
+        self.index = index
+        self.peers = [("127.0.0.1", port + i) for i in range(workers) if i != index]
+        self.port = port + index
+        self.transport = None
+        self.sent = 0
+        self.received = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=("127.0.0.1", self.port))
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def settings_written(self, guild_ids):
+        if self.transport is None:
+            return
+        guild_ids = list(guild_ids)
+        for start in range(0, len(guild_ids), self.MAX_IDS):
+            data = json.dumps({"settings": guild_ids[start:start + self.MAX_IDS]}).encode()
+            for peer in self.peers:
+                self.transport.sendto(data, peer)
+                self.sent += 1
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            guild_ids = json.loads(data)["settings"]
+        except (ValueError, KeyError, TypeError):
+            logging.warning(f"Ignoring malformed notification from {addr}")
+            return
+        self.received += 1
+        for guild_id in guild_ids:
+            forget_settings(guild_id)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class Archer(discord.AutoShardedClient if SHARD_COUNT else discord.Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.http.request
+
+        async def measured_request(route, **kwargs):
+            # by path instead of URL, so all channels share one route
+            name = f"{route.method} {route.path}"
+            started = time.perf_counter()
+            status = "error"
+            try:
+                result = await request(route, **kwargs)
+                status = "ok"
+                return result
+            except discord.HTTPException as e:
+                status = str(e.status)
+                raise
+            finally:
+                metrics.observe("archer_rest_request_seconds", time.perf_counter() - started, route=name)
+                metrics.count("archer_rest_requests_total", route=name, status=status)
+
+        self.http.request = measured_request
+        self.warm = False  # whether warm_up is done
+        self._held = []  # (event, args, kwargs) dispatched before that
+        self._first_event = None  # (handler name, when it was dispatched) of the first event in HELD_EVENTS
+        self._first_event_logged = False
+
+    def dispatch(self, event, *args, **kwargs):
+        if event in HELD_EVENTS:
+            if self._first_event is None:
+                self._first_event = ("on_" + event, time.monotonic())
+            if not self.warm:
+                self._held.append((event, args, kwargs))
+                return
+        super().dispatch(event, *args, **kwargs)
+
+    def warmed_up(self):
+        """ Lets all events through from now on, starting with the held ones. """
+        self.warm = True
+        held, self._held = self._held, []
+        for event, args, kwargs in held:
+            super().dispatch(event, *args, **kwargs)
+        if held:
+            logging.info(f"Dispatched {len(held)} events held back during warm-up")
+
+    async def start(self, *args, **kwargs):
+        # started here instead of in on_ready, which fires on every reconnect
+        self.loop.create_task(sync_index.watch())
+        self.loop.create_task(metrics.watch_loop())
+        if notifier is not None:
+            await notifier.start()
+        if PROFILE_AT_BOOT:
+            profiler.start()
+        if METRICS_PORT:
+            try:
+                await metrics.serve()
+            except OSError as e:
+                # not worth not running at all
+                logging.error(f"Can't serve metrics on {METRICS_HOST}:{METRICS_PORT}: {e!r}")
+        await super().start(*args, **kwargs)
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        if event_name in PROFILED_EVENTS and profiler.wanted():
+            def profiled(*args, **kwargs):
+                return profiler.profile(coro(*args, **kwargs), event_name, args)
+            await super()._run_event(profiled, event_name, *args, **kwargs)
+        else:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+
+        if not self._first_event_logged and self._first_event is not None and event_name == self._first_event[0]:
+            self._first_event_logged = True
+            now = time.monotonic()
+            logging.info(
+                f"First event ({event_name}) handled {now - STARTED:.2f} s after starting, "
+                f"{now - self._first_event[1]:.3f} s after it arrived")
+
+    async def close(self):
+        if notifier is not None:
+            notifier.close()
+        await metrics.close()
+        await lookup_client.close()
+        await settings_store.close()
+        await scheduler.close()
+        await super().close()
 
 
 intents = discord.Intents(members=True, emojis=True,
                           messages=True, reactions=True, guilds=True)
-client = discord.Client(intents=intents)
-settings = Settings()
+client_options = {"intents": intents}
+if LEAN_MEMBER_CACHE:
+    client_options.update(chunk_guilds_at_startup=False, member_cache_flags=discord.MemberCacheFlags.none())
+if SHARD_COUNT:
+    client_options.update(shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None)
+client = Archer(**client_options)
+notifier = PeerNotifier(WORKER_INDEX, WORKERS) if WORKER_INDEX >= 0 else None
+metrics = Metrics()
+profiler = Profiler()
+logging.getLogger("discord.http").addHandler(RateLimitCounter())
+members = MemberCache()
+scheduler = RestScheduler()
+settings_store = SettingsStore()
+role_updates = RoleUpdateQueue()
+reconcile_task = None
+lookup_client = LookupClient()
+lookup_cache = LookupCache()
+sync_index = SyncIndex()
+name_index = NameIndex()
+aur_client = AurClient()
+
+
+def paginate(parts: list, limit: int = MESSAGE_LIMIT) -> list:
+    """
+    Joins the given parts with newlines into as few messages as possible,
+    none longer than limit, splitting only between lines if possible.
+    Code blocks split across messages are closed at the end of the one and
+    reopened (with the same language) at the start of the next.
+    """
+    pages = []
+    current = []  # lines of the current page
+    size = 0  # length of the current page with newlines
+    fence = None  # the line which opened the code block we're in, if any
+
+    for line in "\n".join(parts).split("\n"):
+        toggles = line.startswith("```")
+        # a line that long has to be cut, leaving space for code block fences
+        for i, piece in enumerate(_cut(line, limit - 32)):
+            toggling = toggles and i == 0
+            # a page ending in a code block needs "\n```" to close it
+            inside_after = (fence is not None) != toggling
+            needed = size + (1 if current else 0) + len(piece) + (4 if inside_after else 0)
+            if current and needed > limit:
+                pages.append("\n".join(current + ["```"] if fence else current))
+                current = [fence] if fence else []
+                size = len(fence) if fence else 0
+            size += (1 if current else 0) + len(piece)
+            current.append(piece)
+            if toggling:
+                fence = None if fence else piece
+    pages.append("\n".join(current))
+    # discord doesn't allow sending empty messages
+    return [page for page in pages if page.strip()]
+
+
+def _cut(line: str, limit: int) -> list:
+    if len(line) <= limit:
+        return [line]
+    return [line[start:start + limit] for start in range(0, len(line), limit)]
+
+
+class ReplyBuffer:
+    """
+    Collects all replies to the commands of a message, so they can be sent
+    as few messages as possible, see reply.
+    """
+
+    written = 0  # over all buffers
+    sent = 0
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, content: str):
+        self.parts.append(content)
+        ReplyBuffer.written += 1
+
+    def extend(self, other: "ReplyBuffer"):
+        """ Appends what was written to other, e.g. by a concurrent command. """
+        self.parts.extend(other.parts)
+        other.parts = []
+
+    async def flush(self, channel):
+        parts, self.parts = self.parts, []
+        for page in paginate(parts):
+            await scheduler.send(channel, page)
+            ReplyBuffer.sent += 1
+
+
+# the buffer replies of the message being handled go to, if any
+reply_buffer = contextvars.ContextVar("reply_buffer", default=None)
 
 
 def get_sudo_denied_message(user: discord.Member) -> str:
     user_formatted = f"{user.name}#{user.discriminator} ({user.id})"
-    logging.warning(f"{user_formatted} failed to authenticate as root.")
+    logging.warning(f"{user_formatted} failed to authenticate as root.", extra={
+        "guild": user.guild.id, "user": user.id, "outcome": "denied"})
     return f"{user_formatted} ist nicht in der sudoers Datei. Dieser Vorfall wird gemeldet."
 
 
-def user_has_mod_perm(guild: discord.Guild, user_id: int) -> bool:
-    user = guild.get_member(user_id)
-    return user_id == admin_id or settings.mod_role in user.roles
-
-
-async def reaction_roles_message() -> discord.Message:
-    channel = client.get_channel(settings.roles_channel)
-    message = await channel.fetch_message(settings.roles_msg)
+_mod_cache = {}  # key is the guild id, value is {member id: (whether they are a moderator, expiry)}
+
+
+async def user_has_mod_perm(guild: discord.Guild, user_id: int) -> bool:
+    if user_id == admin_id:
+        return True
+    decisions = _mod_cache.setdefault(guild.id, {})
+    decision, expiry = decisions.get(user_id, (None, 0))
+    if decision is None or expiry < time.monotonic():
+        mod_role = guild_settings(guild).mod_role
+        user = await members.get(guild, user_id)
+        decision = mod_role is not None and user is not None and \
+            mod_role.id in {role.id for role in user.roles}
+        # in lean mode there are no member updates for uncached members, so
+        # the decision is only as good as the member fetched for it
+        expiry = time.monotonic() + MEMBER_CACHE_TTL if LEAN_MEMBER_CACHE else float("inf")
+        decisions[user_id] = (decision, expiry)
+    return decision
+
+
+def forget_mod_perms(guild_id: int, user_id: Optional[int] = None):
+    """ Invalidates the cached moderator decisions of a member or a whole guild. """
+    if user_id is None:
+        _mod_cache.pop(guild_id, None)
+    elif guild_id in _mod_cache:
+        _mod_cache[guild_id].pop(user_id, None)
+
+
+async def reaction_roles_message(menu: RoleMenu) -> Optional[discord.Message]:
+    """ Fetches the whole menu message, including its reactions. None if its channel was deleted. """
+    handle = menu.message()
+    if handle is None:
+        return None
+    message = await handle.fetch()
+    menu.content = message.content
     return message
 
 
-def pretty_role_emoji_assoc() -> str:
+def pretty_role_emoji_assoc(menu: RoleMenu) -> str:
     return "\n".join(map(
         lambda pair: f"  {client.get_emoji(int(pair[0]))} → `{pair[1].name}`",
-        settings.roles.items()
+        # roles deleted in the meantime are None
+        ((emoji, role) for emoji, role in menu.roles.items() if role is not None)
     ))
 
 
-async def edit_reaction_roles_message():
-    if settings.roles_msg and settings.roles_channel:
-        message = await reaction_roles_message()
-        new_content = f"Benutze die Reaktionen unter dieser Nachricht, um dir selber Rollen zu geben.\n{pretty_role_emoji_assoc()}"
-        await message.edit(content=new_content)
+def pretty_menus(settings: Settings) -> str:
+    parts = []
+    for menu in settings.menus.values():
+        if menu.channel_id:
+            parts.append(f"  <#{menu.channel_id}>:")
+        else:
+            parts.append("  Noch ohne Channel:")
+        parts.append(pretty_role_emoji_assoc(menu))
+    return "\n".join(parts)
+
+
+def edit_reaction_roles_message(menu: RoleMenu):
+    """
+    Edits the menu message to show the current roles after MENU_EDIT_DELAY,
+    so a burst of changes results in only one edit.
+    """
+    if menu.edit_task is None and menu.message_id and menu.channel_id:
+        menu.edit_task = asyncio.ensure_future(_edit_reaction_roles_message(menu))
+
+
+async def _edit_reaction_roles_message(menu: RoleMenu):
+    try:
+        await asyncio.sleep(MENU_EDIT_DELAY)
+    finally:
+        menu.edit_task = None
+    if not menu.message_id:
+        # deleted in the meantime
+        return
+    new_content = menu.render()
+    if new_content == menu.content:
+        return
+    handle = menu.message()
+    if handle is None:
+        return
+    try:
+        await scheduler.submit(PRIORITY_REPLIES, handle.edit, content=new_content)
+        menu.content = new_content
+    except discord.HTTPException as e:
+        logging.error(f"Editing the role menu in {menu.channel_id} failed: {e!r}")
+
+
+async def seed_reactions(message: discord.Message, emojis: list):
+    """
+    Adds the given emojis as reactions to the message. The requests are
+    pipelined instead of each waiting for the previous one, discord.py still
+    sends them in order behind the rate limit of the channel.
+    """
+    semaphore = asyncio.Semaphore(REACTION_SEED_CONCURRENCY)
+
+    async def add(emoji):
+        async with semaphore:
+            for attempt in range(ROLE_UPDATE_RETRIES):
+                try:
+                    await scheduler.submit(PRIORITY_REPLIES, message.add_reaction, emoji)
+                    return
+                except discord.HTTPException as e:
+                    if e.status != 429 or attempt == ROLE_UPDATE_RETRIES - 1:
+                        raise
+                    await asyncio.sleep(2 ** attempt)
+
+    await asyncio.gather(*(add(emoji) for emoji in emojis if emoji is not None))
+
+
+async def select_menu(command: list, index: int, message, settings: Settings, create: bool) -> Optional[RoleMenu]:
+    """
+    Returns the role menu in the channel given by command[index], or the only
+    one there is if the command is shorter. With create, a menu is created if
+    there is none yet. Otherwise, tells what's wrong and returns None.
+    """
+    if len(command) > index:
+        if not command[index].isdigit():
+            await reply(message, "Die Channel-ID scheint keine Zahl zu sein. IDs in Discord sind immer Zahlen.")
+            return None
+        channel_id = int(command[index])
+        menu = settings.menus.get(channel_id)
+        if menu is not None:
+            return menu
+        if not create:
+            await reply(message, "In diesem Channel gibt es kein Rollenmenü.")
+            return None
+        if message.guild.get_channel(channel_id) is None:
+            await reply(message, "Der Channel scheint nicht zu existieren.")
+            return None
+        menu = settings.menus[channel_id] = RoleMenu(channel_id)
+        return menu
+
+    if len(settings.menus) == 1:
+        return next(iter(settings.menus.values()))
+    if not settings.menus and create:
+        # until send-role-message is used, see there
+        menu = settings.menus[0] = RoleMenu(0)
+        return menu
+    if not settings.menus:
+        await reply(message, "Es gibt noch kein Rollenmenü.")
+        return None
+    await reply(message, "Es gibt mehrere Rollenmenüs, bitte gib die Channel-ID mit an.")
+    return None
 
 
 async def help(command, message):
     # split up into 2000 chars per message because 2000 is the limit
     for part in HELP_MSG:
-        await message.channel.send(part)
+        await reply(message, part)
 
 
 async def set_prefix(command, message):
     if len(command) < 2:
-        await message.channel.send("Kein neues Präfix angegeben.")
+        await reply(message, "Kein neues Präfix angegeben.")
         return
+    settings = guild_settings(message.guild)
     settings.prefix = command[1]
     settings.save()
-    await message.channel.send(f"Neues Präfix ist nun `{settings.prefix}`.")
+    await reply(message, f"Neues Präfix ist nun `{settings.prefix}`.")
 
 
 async def show(command, message):
+    settings = guild_settings(message.guild)
     if settings.mod_role:
         mod_role = settings.mod_role.name
     else:
         mod_role = "Noch nicht gesetzt."
-    await message.channel.send(f"""\
+    await reply(message, f"""\
 - Version: `{VERSION}`
 - Moderator-Rolle: `{settings.mod_role.name}`
 - Ablenkungswahrscheinlichkeit: `{settings.distraction_probability} %`
 - Präfix: `{settings.prefix}`
+- Lookup-Cache: `{lookup_cache.stats()}`
+- Rollen-Updates: `{role_updates.stats()}`
+- Anfragen: `{scheduler.stats()}`
+- Antworten: `{ReplyBuffer.written} geschrieben, in {ReplyBuffer.sent} Nachrichten gesendet`
+- Gespeichert: `{settings_store.writes} Mal, {settings_store.saves_coalesced} Mal durch Zusammenfassen gespart`
+- Metriken: `{metrics.summary()}`
 - Reaction Roles:
-{pretty_role_emoji_assoc()}""")
+{pretty_menus(settings)}""")
 
 
 async def whoami(command, message):
-    if user_has_mod_perm(message.guild, message.author.id):
-        await message.channel.send(f"Du darfst Einstellungen vornehmen.")
+    if await user_has_mod_perm(message.guild, message.author.id):
+        await reply(message, f"Du darfst Einstellungen vornehmen.")
     else:
-        await message.channel.send(f"Du darfst keine Einstellungen vornehmen.")
+        await reply(message, f"Du darfst keine Einstellungen vornehmen.")
 
 
 async def leetify(command, message):
     if len(command) < 2:
-        await message.channel.send("Mindestens ein Argument ist zum leetifien benötigt.")
+        await reply(message, "Mindestens ein Argument ist zum leetifien benötigt.")
         return
 
     lame = " ".join(command[1:])
@@ -335,255 +2571,636 @@ async def leetify(command, message):
         .replace("B", "8")\
         .replace("o", "0")\
         .replace("O", "0")
-    await message.channel.send(leetified)
+    await reply(message, leetified)
 
 
 async def borkify(command, message):
     if len(command) < 2:
-        await message.channel.send("Mindestens ein Argument ist zum borkifien benötigt.")
+        await reply(message, "Mindestens ein Argument ist zum borkifien benötigt.")
 
     words = " ".join(command[1:]).split(" ")  # avoid weird use of " because of shlex
     borkified = []
     for word in words:
         new_word = f"{word[-1]}{word[1:-1]}{word[0]}"
         borkified.append(new_word)
-    await message.channel.send(" ".join(borkified))
+    await reply(message, " ".join(borkified))
+
+
+def describe_lookup(name: str, result) -> str:
+    """ Formats the result of looking up a single package for a reply. """
+    if isinstance(result, PackageLookupFailed):
+        return "archlinux.org oder das AUR ist gerade nicht erreichbar, versuche es später nochmal."
+    if result is not None:
+        return repr(result)
+
+    suggestions = name_index.fuzzy(name.lower(), SUGGESTIONS)
+    if suggestions:
+        pretty = ", ".join(f"`{name}`" for name in suggestions)
+        return f"Das Paket scheint nicht zu existieren. Meintest du {pretty}?"
+    return "Das Paket scheint nicht zu existieren."
+
+
+async def lookup_packages(names: list) -> list:
+    """
+    Looks up all given packages concurrently, but at most
+    LOOKUP_BATCH_CONCURRENCY at once. Returns the package, None or the
+    PackageLookupFailed for each name, in the same order.
+
+    Packages not in the official repositories are then looked up in the AUR,
+    all of them together in as few requests as possible. Names starting with
+    "aur/" are only looked up in the AUR.
+    """
+    semaphore = asyncio.Semaphore(LOOKUP_BATCH_CONCURRENCY)
+
+    async def lookup_official(name):
+        if name.startswith("aur/"):
+            return None
+        async with semaphore:
+            try:
+                return await Package.by_name(name)
+            except PackageLookupFailed as e:
+                return e
+
+    async def lookup_aur(name):
+        try:
+            return await aur_client.by_name(name[len("aur/"):] if name.startswith("aur/") else name)
+        except PackageLookupFailed as e:
+            return e
+
+    results = await asyncio.gather(*map(lookup_official, names))
+    missing = [i for i, result in enumerate(results) if result is None]
+    # no semaphore needed here, the AurClient batches these anyway
+    aur_results = await asyncio.gather(*(lookup_aur(names[i]) for i in missing))
+    for i, result in zip(missing, aur_results):
+        results[i] = result
+    return results
 
 
 async def lookup(command, message):
     if len(command) < 2:
-        await message.channel.send("Es wurde kein Paket zum Nachschauen angegeben.")
+        await reply(message, "Es wurde kein Paket zum Nachschauen angegeben.")
+        return
+
+    # dict instead of set to keep the order
+    names = list(dict.fromkeys(command[1:]))
+    if len(names) > LOOKUP_BATCH_SIZE:
+        await reply(message, f"Es können höchstens {LOOKUP_BATCH_SIZE} Pakete auf einmal nachgeschaut werden.")
+        return
+
+    results = await lookup_packages(names)
+    if len(names) == 1:
+        await reply(message, describe_lookup(names[0], results[0]))
+        return
+    parts = [f"**{name}**\n{describe_lookup(name, result)}" for name, result in zip(names, results)]
+    for page in paginate(parts):
+        await reply(message, page)
+
+
+async def search(command, message):
+    if len(command) < 2:
+        await reply(message, "Es wurde kein Suchbegriff angegeben.")
+        return
+    if not name_index:
+        await reply(message, "Es sind noch keine Pakete bekannt, in denen gesucht werden könnte.")
         return
 
-    package = Package.by_name(command[1])
-    if package is None:
-        await message.channel.send("Das Paket scheint nicht zu existieren.")
+    results = name_index.search(command[1].lower(), SEARCH_RESULTS)
+    if not results:
+        await reply(message, "Es wurde kein passendes Paket gefunden.")
         return
-    await message.channel.send(repr(package))
+    await reply(message, "```\n{}\n```".format("\n".join(results)))
 
 
 async def rm(command, message):
-    await message.channel.send(random.choice(RM_RESPONSES))
+    # as a reply, so it stays in order with the rest of the script
+    if scheduler.allow_distraction(message.channel):
+        await reply(message, random.choice(RM_RESPONSES))
 
 
 async def set_mod_role(command, message):
     role = get(message.guild.roles, name=command[1])
     if role is None:
-        await message.channel.send("Diese Rolle scheint es nicht zu geben.")
+        await reply(message, "Diese Rolle scheint es nicht zu geben.")
         return
 
+    settings = guild_settings(message.guild)
     settings.mod_role = role
     settings.save()
-    await message.channel.send("Moderator-Rolle erfolgreich gesetzt.")
+    forget_mod_perms(message.guild.id)
+    await reply(message, "Moderator-Rolle erfolgreich gesetzt.")
 
 
 async def send_role_message(command, message):
     if len(command) < 2:
-        await message.channel.send("Kein Channel angegeben.")
+        await reply(message, "Kein Channel angegeben.")
         return
     if not command[1].isdigit():
-        await message.channel.send("Die Channel-ID scheint keine Zahl zu sein. IDs in Discord sind immer Zahlen.")
+        await reply(message, "Die Channel-ID scheint keine Zahl zu sein. IDs in Discord sind immer Zahlen.")
         return
-    channel = client.get_channel(int(command[1]))
+    channel = message.guild.get_channel(int(command[1]))
     if channel is None:
-        await message.channel.send("Der Channel scheint nicht zu existieren.")
+        await reply(message, "Der Channel scheint nicht zu existieren.")
         return
 
-    message = await channel.send("Benutze die Reaktionen unter dieser Nachricht, um dir selber Rollen zu geben.")
-    settings.roles_msg = message.id
-    settings.roles_channel = channel.id
+    settings = guild_settings(message.guild)
+    # roles added before there was any menu are taken over by the first one
+    menu = settings.menus.pop(channel.id, None) or settings.menus.pop(0, None) or RoleMenu(channel.id)
+    menu.channel_id = channel.id
+    settings.menus[channel.id] = menu
+
+    message = await scheduler.submit(PRIORITY_REPLIES, channel.send, MENU_HEADER)
+    menu.sent(message)
     settings.save()
     # add reactions to easily click on them
-    for emoji in map(lambda id: get(message.guild.emojis, id=int(id)), settings.roles.keys()):
-        await message.add_reaction(emoji)
-    await edit_reaction_roles_message()
+    await seed_reactions(message, [get(message.guild.emojis, id=int(id)) for id in menu.roles.keys()])
+    edit_reaction_roles_message(menu)
 
 
 async def add_role(command, message):
     if len(command) < 3:
-        await message.channel.send("Es wurden zu wenig Argumente angegeben.")
+        await reply(message, "Es wurden zu wenig Argumente angegeben.")
         return
 
     emoji_match = EMOJI_REGEX.match(command[1])
     if emoji_match is None:
-        await message.channel.send("Das erste Argument scheint kein custom Emoji sein.")
+        await reply(message, "Das erste Argument scheint kein custom Emoji sein.")
         return
     emoji_id = emoji_match.group(1)
 
     role = get(message.guild.roles, name=command[2])
     if role is None:
-        await message.channel.send("Diese Rolle scheint es nicht zu geben.")
-        return
-    if role in settings.roles.values():
-        await message.channel.send("Die Rolle ist bereits verlinkt.")
+        await reply(message, "Diese Rolle scheint es nicht zu geben.")
         return
-
     # check if the emoji exists at all in the guild
     emoji = get(message.guild.emojis, id=int(emoji_id))
     if emoji is None:
-        await message.channel.send("Der Emoji existiert nicht auf diesem Server.")
+        await reply(message, "Der Emoji existiert nicht auf diesem Server.")
+        return
+
+    settings = guild_settings(message.guild)
+    menu = await select_menu(command, 3, message, settings, create=True)
+    if menu is None:
+        return
+    if role in menu.roles.values():
+        await reply(message, "Die Rolle ist bereits verlinkt.")
         return
 
-    settings.roles[emoji_id] = role
+    menu.link(emoji_id, role)
     settings.save()
-    await message.channel.send("Rolle verlinkt.")
+    await reply(message, "Rolle verlinkt.")
 
     # add the new role to the message, if it was sent yet
-    if settings.roles_msg is None:
+    handle = menu.message() if menu.message_id is not None else None
+    if handle is None:
+        # the message might just have turned out to be gone along with its channel
+        settings.save()
         return
-    message = await reaction_roles_message()
-    await message.add_reaction(emoji)
-    await edit_reaction_roles_message()
+    await scheduler.submit(PRIORITY_REPLIES, handle.add_reaction, emoji)
+    edit_reaction_roles_message(menu)
 
 
 async def remove_role(command, message):
     if len(command) < 2:
-        await message.channel.send("Kein Emoji angegeben.")
+        await reply(message, "Kein Emoji angegeben.")
         return
 
     emoji_match = EMOJI_REGEX.match(command[1])
     if emoji_match is None:
-        await message.channel.send("Das Argument scheint kein custom Emoji sein.")
+        await reply(message, "Das Argument scheint kein custom Emoji sein.")
         return
     emoji_id = emoji_match.group(1)
 
-    if emoji_id not in settings.roles.keys():
-        await message.channel.send("Es gibt gar keine Rolle für diesen Emoji.")
+    settings = guild_settings(message.guild)
+    if len(command) < 3:
+        # without a channel, any menu having the emoji will do if it's only one
+        candidates = [menu for menu in settings.menus.values() if emoji_id in menu.roles]
+        if len(candidates) == 1:
+            command = command + [str(candidates[0].channel_id)]
+    menu = await select_menu(command, 2, message, settings, create=False)
+    if menu is None:
+        return
+    if emoji_id not in menu.roles.keys():
+        await reply(message, "Es gibt gar keine Rolle für diesen Emoji.")
         return
 
-    del settings.roles[emoji_id]
+    menu.unlink(emoji_id)
     settings.save()
-    await message.channel.send("Rolle gelöscht.")
+    await reply(message, "Rolle gelöscht.")
 
-    if settings.roles_msg is None:
+    handle = menu.message() if menu.message_id is not None else None
+    if handle is None:
+        # the message might just have turned out to be gone along with its channel
+        settings.save()
         return
-    message = await reaction_roles_message()
     emoji = get(message.guild.emojis, id=int(emoji_id))
-    await message.remove_reaction(emoji, message.author)
-    await edit_reaction_roles_message()
+    if emoji is not None:
+        await scheduler.submit(PRIORITY_REPLIES, handle.remove_reaction, emoji, client.user)
+    edit_reaction_roles_message(menu)
 
 
 async def distraction_probability(command, message):
     if len(command) < 2:
-        await message.channel.send("Keine Wahrscheinlichkeit angegeben.")
+        await reply(message, "Keine Wahrscheinlichkeit angegeben.")
         return
 
     # Do some checks first if the given argument is valid or not
     if not command[1].isdigit():
-        await message.channel.send("Die Wahrscheinlichkeit scheint keine Zahl zu sein.")
+        await reply(message, "Die Wahrscheinlichkeit scheint keine Zahl zu sein.")
         return
 
     new_distract_num = int(command[1])
 
     if (new_distract_num > 100):
-        await message.channel.send("Bitte eine Zahl im Bereich von 0-100.")
+        await reply(message, "Bitte eine Zahl im Bereich von 0-100.")
         return
 
+    settings = guild_settings(message.guild)
     settings.distraction_probability = new_distract_num
     settings.save()
-    await message.channel.send(f"Ablenkungswahrscheinlichkeit auf `{settings.distraction_probability} %` gesetzt.")
+    await reply(message, f"Ablenkungswahrscheinlichkeit auf `{settings.distraction_probability} %` gesetzt.")
+
+
+async def profile(command, message):
+    action = command[1] if len(command) > 1 else None
+    if action == "start":
+        if profiler.running:
+            await reply(message, "Es wird bereits aufgezeichnet.")
+            return
+        profiler.start()
+        await reply(message, "Aufzeichnung gestartet.")
+    elif action == "stop":
+        profiler.stop()
+        await reply(message, "Aufzeichnung gestoppt.")
+    elif action == "dump":
+        path = await profiler.dump()
+        if path is None:
+            await reply(message, "Es wurde noch nichts aufgezeichnet.")
+            return
+        await reply(message, f"Gespeichert in `{os.path.relpath(path, os.path.dirname(PERSISTENT_PATH))}`.\n```\n{profiler.summary()}\n```")
+    else:
+        await reply(message, "Benutze `profile start`, `profile stop` oder `profile dump`.")
 
 
 COMMANDS = {
-    "help": {"fn": help, "requires_mod": False},
-    "prefix": {"fn": set_prefix, "requires_mod": True},
-    "show": {"fn": show, "requires_mod": False},
-    "whoami": {"fn": whoami, "requires_mod": False},
-    "leetify": {"fn": leetify, "requires_mod": False},
-    "borkify": {"fn": borkify, "requires_mod": False},
-    "lookup": {"fn": lookup, "requires_mod": False},
-    "rm": {"fn": rm, "requires_mod": False},
-    "set-mod-role": {"fn": set_mod_role, "requires_mod": True},
-    "send-role-message": {"fn": send_role_message, "requires_mod": True},
-    "add-role": {"fn": add_role, "requires_mod": True},
-    "remove-role": {"fn": remove_role, "requires_mod": True},
-    "distraction-probability": {"fn": distraction_probability, "requires_mod": True}
+    "help": {"fn": help, "requires_mod": False, "read_only": True},
+    "prefix": {"fn": set_prefix, "requires_mod": True, "read_only": False},
+    "show": {"fn": show, "requires_mod": False, "read_only": True},
+    "whoami": {"fn": whoami, "requires_mod": False, "read_only": True},
+    "leetify": {"fn": leetify, "requires_mod": False, "read_only": True},
+    "borkify": {"fn": borkify, "requires_mod": False, "read_only": True},
+    "lookup": {"fn": lookup, "requires_mod": False, "read_only": True},
+    "search": {"fn": search, "requires_mod": False, "read_only": True},
+    "rm": {"fn": rm, "requires_mod": False, "read_only": False},
+    "set-mod-role": {"fn": set_mod_role, "requires_mod": True, "read_only": False},
+    "send-role-message": {"fn": send_role_message, "requires_mod": True, "read_only": False},
+    "add-role": {"fn": add_role, "requires_mod": True, "read_only": False},
+    "remove-role": {"fn": remove_role, "requires_mod": True, "read_only": False},
+    "distraction-probability": {"fn": distraction_probability, "requires_mod": True, "read_only": False},
+    "profile": {"fn": profile, "requires_mod": True, "read_only": False},
 }
+# read_only commands change nothing, so a script runs them concurrently, see run_script
+# COMMANDS precompiled for on_message, key is the name, value is (fn, requires_mod, read_only)
+DISPATCH = {name: (command["fn"], command["requires_mod"], command["read_only"])
+            for name, command in COMMANDS.items()}
+
+
+def command_lines(content: str, prefix: str) -> list:
+    """
+    Returns the lines of the message which are commands, without the prefix.
+    Ordinary chat is rejected without splitting the message at all.
+    """
+    if prefix not in content:
+        return []
+    return [line[len(prefix):] for line in content.splitlines() if line.startswith(prefix)]
+
+
+def tokenize(line: str) -> list:
+    """ Splits a command line like a shell would. """
+    if QUOTING_REGEX.search(line) is None:
+        # shlex is slow, and without quoting it would split just like this
+        return TOKEN_REGEX.findall(line)
+    return shlex.split(line)
+
+
+def wants_distraction(content: str, settings: Settings) -> bool:
+    # cheapest checks first, randint only ever returns at least 1
+    # (lower() and in beat a case insensitive regex by far, see bench.py)
+    return settings.distraction_probability > 1 and \
+        "arch" in content.lower() and \
+        random.randint(1, 100) < settings.distraction_probability
 
 
 @client.event
 async def on_ready():
+    global reconcile_task
     logging.info(f"Login as {client.user}")
+    if not client.warm:
+        # on_ready fires again on every reconnect, but there's nothing to load then
+        started = time.monotonic()
+        try:
+            await warm_up(client.guilds)
+            logging.info(f"Loaded the settings of {len(client.guilds)} guilds in {time.monotonic() - started:.2f} s")
+        finally:
+            client.warmed_up()
+    # ru_maxrss is in KiB on linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    mode = "lean" if LEAN_MEMBER_CACHE else "full"
+    logging.info(
+        f"Ready after {time.monotonic() - STARTED:.2f} s with {max_rss:.1f} MiB max RSS "
+        f"({mode} member cache, {sum(len(guild.members) for guild in client.guilds)} members cached)")
+    # in the background, so commands are handled in the meantime
+    if reconcile_task is None or reconcile_task.done():
+        reconcile_task = asyncio.ensure_future(reconcile_reaction_roles())
 
 
 @client.event
-async def on_message(message):
-    global settings
-    if not settings.loaded:
-        settings.load(message.guild)
-    is_command = False
+async def on_guild_available(guild):
+    # unavailable during warm_up, so without roles and channels to load its settings with then
+    if client.warm and guild.id not in _settings_cache:
+        guild_settings(guild)
 
+
+@client.event
+async def on_guild_join(guild):
+    # joined after warm_up, so its role menus (should it have been here before) aren't indexed yet
+    guild_settings(guild)
+
+
+@client.event
+async def on_message(message):
     if message.author == client.user:
         return
 
     if message.guild is None:
-        await message.channel.send("Du kannst diesen Bot nicht in Direktnachrichten benutzen.")
+        await reply(message, "Du kannst diesen Bot nicht in Direktnachrichten benutzen.")
         return
+    settings = guild_settings(message.guild)
+    content = message.content
+    if LEAN_MEMBER_CACHE and isinstance(message.author, discord.Member):
+        members.put(message.author)
 
-    if any(map(lambda user: user.id == client.user.id, message.mentions)):
-        await message.channel.send(f"Der derzeitige Prefix ist `{settings.prefix}`.")
+    if message.mentions and any(user.id == client.user.id for user in message.mentions):
+        await reply(message, f"Der derzeitige Prefix ist `{settings.prefix}`.")
         return
 
     # for "scripts"
-    lines = message.content.splitlines()
-    for line in lines:
-        if line.startswith(settings.prefix):
-            is_command = True
-            command = line[len(settings.prefix):]  # strip the prefix
-            # shlex allows easy shell-like parsing
-            command = shlex.split(command)
-
-            logging.info(
-                f"Command issued by {message.author.name}#{message.author.discriminator}: {command}")
-
+    lines = command_lines(content, settings.prefix)
+    if lines:
+        buffer = ReplyBuffer()
+        token = reply_buffer.set(buffer)
+        try:
+            await run_script(lines, message, settings)
+        finally:
+            reply_buffer.reset(token)
+            await buffer.flush(message.channel)
+    elif wants_distraction(content, settings):
+        sent = await scheduler.distract(message.channel, random.choice(ARCH_RESPONSES))
+        log_sampled("Distraction", guild=message.guild.id, channel=message.channel.id,
+                    outcome="sent" if sent else "dropped")
+
+
+async def run_script(lines: list, message: discord.Message, settings: Settings):
+    """
+    Runs the given command lines. Read-only commands run concurrently, every
+    other command waits for all lines before it and holds back all after it.
+    Replies are in the order of the lines either way.
+    """
+    pending = []  # (task, buffer) of read-only commands still running, in order
+    try:
+        for line in lines:
+            command = tokenize(line)
             if not command:  # e.g. just 'archer' or 'archer '
                 continue
 
-            if command[0] in COMMANDS.keys():
-                if COMMANDS[command[0]]["requires_mod"]:
-                    if not user_has_mod_perm(message.guild, message.author.id):
-                        await message.channel.send(get_sudo_denied_message(message.author))
-                        return
-                await COMMANDS[command[0]]["fn"](command, message)
-            else:
-                await message.channel.send(f"Unbekannter Befehl. Benutze `{settings.prefix}help` für Hilfe.")
+            entry = DISPATCH.get(command[0])
+            if entry is None:
+                metrics.count("archer_commands_total", command="unknown", outcome="unknown")
+                log_command(message, command, "unknown")
+                await join_commands(pending)
+                await reply(message, f"Unbekannter Befehl. Benutze `{settings.prefix}help` für Hilfe.")
                 return
+            fn, requires_mod, read_only = entry
+            if read_only and not requires_mod:
+                buffer = ReplyBuffer()
+                pending.append((asyncio.ensure_future(run_buffered(fn, command, message, buffer)), buffer))
+                continue
+
+            await join_commands(pending)
+            if requires_mod and not await user_has_mod_perm(message.guild, message.author.id):
+                metrics.count("archer_commands_total", command=command[0], outcome="denied")
+                log_command(message, command, "denied")
+                await reply(message, get_sudo_denied_message(message.author))
+                return
+            await run_command(fn, command, message)
+        await join_commands(pending)
+    finally:
+        # only left over if something went wrong, the rest of the script is void then
+        for task, _ in pending:
+            task.cancel()
+
+
+async def run_buffered(fn, command: list, message: discord.Message, buffer: ReplyBuffer):
+    # a task has its own copy of the context, so this doesn't affect the script
+    reply_buffer.set(buffer)
+    await run_command(fn, command, message)
+
+
+async def run_command(fn, command: list, message: discord.Message):
+    """ Runs the command and records how long it took, see Metrics. """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        if profiler.wanted():
+            await profiler.profile(fn(command, message), command[0], tuple(command[1:]))
+        else:
+            await fn(command, message)
+        outcome = "ok"
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        latency = time.perf_counter() - started
+        metrics.observe("archer_command_seconds", latency, command=command[0])
+        metrics.count("archer_commands_total", command=command[0], outcome=outcome)
+        log_command(message, command, outcome, latency)
+
+
+def log_command(message: discord.Message, command: list, outcome: str, latency: Optional[float] = None):
+    author = message.author
+    logging.info(f"Command issued by {author.name}#{author.discriminator}: {command}", extra={
+        "guild": message.guild.id,
+        "channel": message.channel.id,
+        "user": author.id,
+        "command": command[0],
+        "arguments": command[1:],
+        "latency": round(latency, 6) if latency is not None else None,
+        "outcome": outcome,
+    })
+
+
+async def join_commands(pending: list):
+    """ Waits for the given concurrent commands and passes on their replies in order. """
+    while pending:
+        task, buffer = pending[0]
+        await task
+        del pending[0]
+        reply_buffer.get().extend(buffer)
+
+
+def menu_for_message(guild_id: Optional[int], message_id: int) -> tuple:
+    """ Returns (settings, menu) of the role menu with the given message, if any. """
+    guild = client.get_guild(guild_id) if guild_id is not None else None
+    if guild is None:
+        return None, None
+    settings = guild_settings(guild)
+    return settings, settings.menu_by_message(message_id)
+
+
+@client.event
+async def on_raw_message_edit(payload):
+    settings, menu = menu_for_message(payload.guild_id, payload.message_id)
+    if menu is not None and "content" in payload.data:
+        menu.content = payload.data["content"]
+
+
+@client.event
+async def on_raw_message_delete(payload):
+    settings, menu = menu_for_message(payload.guild_id, payload.message_id)
+    if menu is not None:
+        logging.info(f"The role menu in {menu.channel_id} was deleted")
+        menu.deleted()
+        settings.save()
+
+
+@client.event
+async def on_raw_bulk_message_delete(payload):
+    for message_id in payload.message_ids:
+        settings, menu = menu_for_message(payload.guild_id, message_id)
+        if menu is not None:
+            logging.info(f"The role menu in {menu.channel_id} was deleted")
+            menu.deleted()
+            settings.save()
+
+
+@client.event
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        forget_mod_perms(after.guild.id, after.id)
+        role_updates.confirm(after)
+
 
-    if "arch" in message.content.lower() and \
-            not is_command and \
-            random.randint(1, 100) < settings.distraction_probability:
-        await message.channel.send(random.choice(ARCH_RESPONSES))
+@client.event
+async def on_member_remove(member):
+    forget_mod_perms(member.guild.id, member.id)
+
+
+@client.event
+async def on_guild_role_delete(role):
+    # members lose the role without any member update
+    forget_mod_perms(role.guild.id)
 
 
 @client.event
 async def on_raw_reaction_add(payload):
-    if not settings.loaded:
-        settings.load(client.get_guild(payload.guild_id))
     if payload.user_id == client.user.id:
         # avoid applying roles to self
         return
+    role_id = menu_role(payload.message_id, payload.emoji.id)
+    if role_id is None:
+        metrics.count("archer_reactions_total", event="add", outcome="ignored")
+        log_sampled("Reaction ignored", guild=payload.guild_id, channel=payload.channel_id,
+                    event="reaction_add", outcome="ignored")
+        return
 
-    emoji_matches = str(payload.emoji.id) in settings.roles.keys()
-    message_matches = payload.message_id == settings.roles_msg
-    if emoji_matches and message_matches:
-        # can't use get_user here because we need a Member, not a User
-        guild = client.get_guild(payload.guild_id)
-        member = guild.get_member(payload.user_id)
-        role = settings.roles[str(payload.emoji.id)]
-        await member.add_roles(role, reason="Automatically through Reaction Roles")
+    guild = client.get_guild(payload.guild_id)
+    # can't use get_user here because we need a Member, not a User
+    member = payload.member
+    if LEAN_MEMBER_CACHE and member is not None:
+        members.put(member)
+    role = guild.get_role(role_id)
+    if member is not None and role is not None:
+        role_updates.add(member, role)
+        metrics.count("archer_reactions_total", event="add", outcome="processed")
+    else:
+        metrics.count("archer_reactions_total", event="add", outcome="dropped")
 
 
 @client.event
 async def on_raw_reaction_remove(payload):
-    if not settings.loaded:
-        settings.load(client.get_guild(payload.guild_id))
-    emoji_matches = str(payload.emoji.id) in settings.roles.keys()
-    message_matches = payload.message_id == settings.roles_msg
-    if emoji_matches and message_matches:
-        guild = client.get_guild(payload.guild_id)
-        member = guild.get_member(payload.user_id)
-        role = settings.roles[str(payload.emoji.id)]
-        await member.remove_roles(role, reason="Automatically through Reaction Roles")
+    role_id = menu_role(payload.message_id, payload.emoji.id)
+    if role_id is None:
+        metrics.count("archer_reactions_total", event="remove", outcome="ignored")
+        log_sampled("Reaction ignored", guild=payload.guild_id, channel=payload.channel_id,
+                    event="reaction_remove", outcome="ignored")
+        return
+
+    guild = client.get_guild(payload.guild_id)
+    # there's no member in the payload for removed reactions
+    member = await members.get(guild, payload.user_id)
+    role = guild.get_role(role_id)
+    if member is not None and role is not None:
+        role_updates.remove(member, role)
+        metrics.count("archer_reactions_total", event="remove", outcome="processed")
+    else:
+        metrics.count("archer_reactions_total", event="remove", outcome="dropped")
+
+
+def shard_ranges(shard_count: int, workers: int) -> list:
+    """ Splits the shards into a consecutive range for each worker. """
+    return [list(range(shard_count * i // workers, shard_count * (i + 1) // workers)) for i in range(workers)]
+
+
+async def launch(workers: int):
+    """
+    Runs the bot in the given number of worker processes, each handling a
+    range of the SHARD_COUNT shards (as many as there are workers if not
+    set), and restarts workers which crash until told to stop.
+    """
+    shard_count = SHARD_COUNT or workers
+    # a worker without shards would handle all of them
+    workers = min(workers, shard_count)
+    # the schema is created once here, instead of by all workers at the same time
+    SettingsStore()._connect().close()
+
+    processes = {}  # key is the worker index
+    stopping = False
+
+    def stop():
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.returncode is None:
+                process.terminate()
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop)
+
+    async def supervise(index: int, shard_ids: list):
+        env = dict(
+            os.environ,
+            WORKER_INDEX=str(index),
+            SHARD_COUNT=str(shard_count),
+            SHARD_IDS=",".join(map(str, shard_ids)),
+            # every worker needs a port of its own
+            METRICS_PORT=str(METRICS_PORT + index if METRICS_PORT else 0))
+        delay = WORKER_RESTART_DELAY
+        while not stopping:
+            started = time.monotonic()
+            processes[index] = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.realpath(__file__), env=env)
+            code = await processes[index].wait()
+            if stopping or code == 0:
+                return
+            if time.monotonic() - started > WORKER_STABLE_TIME:
+                delay = WORKER_RESTART_DELAY
+            logging.error(f"Worker {index} (shards {shard_ids}) exited with {code}, restarting in {delay} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WORKER_RESTART_DELAY_MAX)
+
+    ranges = shard_ranges(shard_count, workers)
+    logging.info(f"Starting {workers} workers for {shard_count} shards")
+    await asyncio.gather(*(supervise(index, shard_ids) for index, shard_ids in enumerate(ranges)))
 
 
 if __name__ == "__main__":
@@ -598,5 +3215,13 @@ if __name__ == "__main__":
         with open(os.path.join(PERSISTENT_PATH, "ADMIN-ID")) as fh:
             admin_id = int(fh.read())
 
-    logging.basicConfig(encoding="utf-8", format=LOGFORMAT, level=logging.INFO)
-    client.run(token)
+    log_listener = setup_logging()
+    try:
+        if WORKERS > 1 and WORKER_INDEX < 0:
+            asyncio.run(launch(WORKERS))
+        else:
+            client.run(token)
+    finally:
+        if DroppingQueueHandler.dropped:
+            logging.warning(f"Dropped {DroppingQueueHandler.dropped} log records since the log couldn't keep up")
+        log_listener.stop()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# main.py isn't a package, so make it importable from within tests/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+import aiohttp.web
+import pytest
+from aiohttp.test_utils import TestServer
+
+import main
+
+
+def aur_result(name: str) -> dict:
+    return {"Name": name, "Version": "1.0-1", "LastModified": 1700000000, "FirstSubmitted": 1600000000}
+
+
+def found(names: list) -> str:
+    """ Answers like the AUR RPC, knowing every package except "missing". """
+    results = [aur_result(name) for name in names if name != "missing"]
+    return json.dumps({"version": 5, "type": "multiinfo", "resultcount": len(results), "results": results})
+
+
+def look_up(monkeypatch, names: list, answer=found, status: int = 200):
+    """
+    Looks up all names at once against a stub of the AUR RPC answering with
+    answer(names asked for). Returns the results (or exceptions) and the
+    names asked for in each request.
+    """
+    requests = []
+
+    async def rpc(request):
+        assert request.query["v"] == "5" and request.query["type"] == "info"
+        batch = request.query.getall("arg[]")
+        requests.append(batch)
+        return aiohttp.web.Response(text=answer(batch), status=status, content_type="application/json")
+
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get("/rpc/", rpc)
+        server = TestServer(app)
+        await server.start_server()
+        monkeypatch.setattr(main, "AUR_URL", str(server.make_url("")).rstrip("/"))
+        monkeypatch.setattr(main, "lookup_client", main.LookupClient())
+        monkeypatch.setattr(main, "lookup_cache", main.LookupCache())
+        client = main.AurClient()
+        try:
+            lookups = asyncio.gather(*(client.by_name(name) for name in names), return_exceptions=True)
+            # lookups nobody finishes would wait forever
+            return await asyncio.wait_for(lookups, 5)
+        finally:
+            await main.lookup_client.close()
+            await server.close()
+
+    return asyncio.run(run()), requests
+
+
+def test_concurrent_lookups_are_batched(monkeypatch):
+    results, requests = look_up(monkeypatch, ["yay", "paru", "Missing"])
+
+    assert requests == [["yay", "paru", "missing"]]
+    assert [package.name for package in results[:2]] == ["yay", "paru"]
+    assert all(package.aur and package.size is None for package in results[:2])
+    assert results[2] is None
+
+
+def test_same_name_is_asked_for_once(monkeypatch):
+    results, requests = look_up(monkeypatch, ["yay", "YAY", "yay"])
+
+    assert requests == [["yay"]]
+    assert [package.name for package in results] == ["yay"] * 3
+
+
+def test_batches_are_limited(monkeypatch):
+    monkeypatch.setattr(main, "AUR_BATCH_SIZE", 2)
+    results, requests = look_up(monkeypatch, ["a", "b", "c"])
+
+    assert sorted(map(len, requests)) == [1, 2]
+    assert sorted(name for batch in requests for name in batch) == ["a", "b", "c"]
+    assert [package.name for package in results] == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize("answer", [
+    lambda names: json.dumps({"version": 5, "type": "error", "results": [], "error": "Too many package results."}),
+    lambda names: json.dumps([]),
+    lambda names: "<html>Service Unavailable</html>",
+    lambda names: json.dumps({"type": "multiinfo", "results": [{"Name": name} for name in names]}),
+    lambda names: json.dumps({"type": "multiinfo"}),
+], ids=["error", "not an object", "not json", "incomplete results", "no results"])
+def test_unexpected_answers_fail_the_whole_batch(monkeypatch, answer):
+    results, requests = look_up(monkeypatch, ["yay", "paru"], answer)
+
+    assert len(requests) == 1
+    assert all(isinstance(result, main.PackageLookupFailed) for result in results)
+
+
+def test_server_errors_fail_the_whole_batch(monkeypatch):
+    results, requests = look_up(monkeypatch, ["yay", "paru"], status=502)
+
+    assert len(requests) == 1
+    assert all(isinstance(result, main.PackageLookupFailed) for result in results)
@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+import io
+import os
+import tarfile
+
+import main
+
+
+def desc(name: str, version: str, size: int = 1024, build_date: int = 1700000000) -> str:
+    return (
+        f"%FILENAME%\n{name}-{version}-x86_64.pkg.tar.zst\n\n"
+        f"%NAME%\n{name}\n\n"
+        f"%VERSION%\n{version}\n\n"
+        f"%DESC%\nThe {name} package\n\n"
+        f"%ISIZE%\n{size}\n\n"
+        f"%BUILDDATE%\n{build_date}\n\n"
+        f"%DEPENDS%\nglibc\nbash\n\n")
+
+
+def write_db(path: str, descs: dict, mode: str = "w:gz"):
+    """ Writes a sync database like pacman's, with one directory and desc file per package. """
+    with tarfile.open(path, mode) as tar:
+        for directory, content in descs.items():
+            info = tarfile.TarInfo(directory)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            data = content.encode()
+            info = tarfile.TarInfo(f"{directory}/desc")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_parse_desc():
+    assert main._parse_desc(desc("bash", "5.2.026-2", 9437184, 1707153386)) == \
+        ("bash", "5.2.026-2", 9437184, 1707153386)
+
+
+def test_parse_desc_takes_first_line_of_fields():
+    text = "%NAME%\nbash\nnot-bash\n\n%VERSION%\n5.2-1\n\n%BUILDDATE%\n1\n"
+    assert main._parse_desc(text) == ("bash", "5.2-1", 0, 1)
+
+
+def test_parse_desc_rejects_incomplete():
+    assert main._parse_desc("%NAME%\nbash\n\n%VERSION%\n5.2-1\n") is None
+    assert main._parse_desc("%NAME%\nbash\n\n%VERSION%\n5.2-1\n\n%BUILDDATE%\nyesterday\n") is None
+    assert main._parse_desc("") is None
+
+
+def test_load_sync_dbs(tmp_path):
+    core = str(tmp_path / "core.db")
+    extra = str(tmp_path / "extra.db")
+    write_db(core, {"bash-5.2.026-2": desc("bash", "5.2.026-2"), "glibc-2.39-1": desc("glibc", "2.39-1")})
+    write_db(extra, {"python-3.12.3-1": desc("python", "3.12.3-1", 2048, 1713000000)}, mode="w:xz")
+
+    packages = main._load_sync_dbs([core, extra])
+
+    assert packages == {
+        "bash": ("5.2.026-2", 1024, 1700000000),
+        "glibc": ("2.39-1", 1024, 1700000000),
+        "python": ("3.12.3-1", 2048, 1713000000),
+    }
+
+
+def test_load_sync_dbs_skips_broken_desc(tmp_path):
+    core = str(tmp_path / "core.db")
+    write_db(core, {"bash-5.2.026-2": desc("bash", "5.2.026-2"), "broken-1-1": "%NAME%\nbroken\n"})
+
+    assert list(main._load_sync_dbs([core])) == ["bash"]
+
+
+def test_refresh_and_get(tmp_path):
+    write_db(str(tmp_path / "core.db"), {"bash-5.2.026-2": desc("bash", "5.2.026-2")})
+    # not one of the repos, so ignored
+    write_db(str(tmp_path / "testing.db"), {"glibc-2.40-1": desc("glibc", "2.40-1")})
+    index = main.SyncIndex(str(tmp_path), repos=("core", "extra"))
+
+    assert not index
+    assert asyncio.run(index.refresh())
+    assert len(index) == 1
+
+    package = index.get("bash")
+    assert (package.name, package.version, package.size) == ("bash", "5.2.026-2", 1024)
+    assert package.creation_date == datetime.date.fromtimestamp(1700000000)
+    assert not package.aur
+    assert index.get("glibc") is None
+
+
+def test_refresh_only_reloads_changed_databases(tmp_path):
+    core = str(tmp_path / "core.db")
+    write_db(core, {"bash-5.2.026-2": desc("bash", "5.2.026-2")})
+    index = main.SyncIndex(str(tmp_path), repos=("core",))
+
+    assert asyncio.run(index.refresh())
+    assert not asyncio.run(index.refresh())
+
+    write_db(core, {"bash-5.2.026-3": desc("bash", "5.2.026-3")})
+    # the file might have been written within the same tick of the clock
+    stat = os.stat(core)
+    os.utime(core, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert asyncio.run(index.refresh())
+    assert index.get("bash").version == "5.2.026-3"